@@ -19,23 +19,518 @@ import re
 import subprocess
 import sys
 import datetime
+import fnmatch
+import functools
 import tempfile
-import shutil
+import hashlib
+import io
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+from typing import Callable, Iterable, Iterator
 
 import dotenv
 from github import Github, Auth
 from github.PullRequest import PullRequest
-from github.GithubException import UnknownObjectException
+from github.GithubException import GithubException, UnknownObjectException
 
 from notion_client import Client as NotionClient
-from notion2md.exporter.block import StringExporter
+from notion_client.errors import APIErrorCode, APIResponseError, HTTPResponseError, RequestTimeoutError
 
-from unidiff import PatchSet
+from unidiff import PatchSet, PatchedFile
 
-from openai import OpenAI
+from openai import APIConnectionError, APIError, APIStatusError, APITimeoutError, OpenAI
+
+import tiktoken
 
 dotenv.load_dotenv()
 
+# 캐시 파일을 저장할 디렉토리 (GitHub Actions 에서는 actions/cache 와 함께 사용)
+CACHE_DIR = os.getenv("AI_PR_WRITER_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".cache", "ai-pr-writer")
+# 같은 입력에 대한 LLM 응답을 CACHE_DIR 에 저장해 재사용할지 여부
+LLM_CACHE_ENABLED = (os.getenv("LLM_CACHE") or "on") != "off"
+# LLM 응답을 스트리밍으로 받아 생성되는 대로 출력할지 여부
+LLM_STREAM_ENABLED = (os.getenv("LLM_STREAM") or "off") == "on"
+# LLM 응답 하나를 기다리는 최대 시간(초)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT") or 600)
+# 새 커밋이 push 될 때 이전 본문과 추가된 diff 만으로 본문을 갱신할지 여부
+INCREMENTAL_ENABLED = (os.getenv("INCREMENTAL") or "off") == "on"
+HEAD_MARKER_PATTERN = re.compile(r"<!-- ai-pr-writer head=([0-9a-f]{40}) -->\s*$")
+# 본문을 작성한 PR 에 붙이는 라벨
+LABEL_NAME = os.getenv("LABEL") or "ai-pr-written"
+# 노션 접두사 캐시 유효 시간(초), 기본 1일
+NOTION_PREFIX_CACHE_TTL = int(os.getenv("NOTION_PREFIX_CACHE_TTL") or 24 * 60 * 60)
+# 캐시에 없는 접두사 때문에 전체 검색을 다시 할 수 있는 최소 간격(초), 기본 1시간
+NOTION_PREFIX_REFRESH_INTERVAL = int(os.getenv("NOTION_PREFIX_REFRESH_INTERVAL") or 60 * 60)
+# 노션의 last_edited_time 은 분 단위로 기록되므로, 이보다 최근에 수정된 페이지는 캐시하지 않습니다(초).
+NOTION_PAGE_CACHE_MIN_AGE = 120
+
+# LLM 프롬프트 전체(시스템 프롬프트 포함)의 최대 토큰 수
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS") or 100_000)
+# 프롬프트에 넣는 기존 PR 본문의 최대 토큰 수 (전체 예산의 1/4)
+MAX_PR_BODY_TOKENS = MAX_PROMPT_TOKENS // 4
+# 파일 하나에 대해 메모리에 읽어 들일 diff 의 최대 크기(바이트)
+MAX_FILE_DIFF_BYTES = int(os.getenv("MAX_FILE_DIFF_BYTES") or 256 * 1024)
+# PR 전체에 대해 메모리에 읽어 들일 diff 의 최대 크기(바이트)
+MAX_TOTAL_DIFF_BYTES = int(os.getenv("MAX_TOTAL_DIFF_BYTES") or 16 * MAX_FILE_DIFF_BYTES)
+TOKENIZER_ENCODING = "o200k_base"
+# diff 가 예산을 넘을 때 파일 묶음별 요약(map-reduce)을 사용할지 여부: auto, off
+MAP_REDUCE_MODE = os.getenv("MAP_REDUCE_MODE") or "auto"
+# 모델 백엔드: openai (OpenAI 호환 API) 또는 fake (네트워크 없이 동작하는 결정적 가짜 응답)
+LLM_BACKEND = os.getenv("LLM_BACKEND") or "openai"
+# OpenAI 호환 API 주소. 비어 있으면 OpenAI 기본값(OPENAI_BASE_URL 또는 api.openai.com)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+# 파일 묶음 요약에 사용할 저렴하고 빠른 모델
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL") or "gpt-4o-mini"
+# PR 크기에 따라 모델을 고를지 여부: on, off
+LLM_ROUTING_ENABLED = (os.getenv("LLM_ROUTING") or "off") == "on"
+# 작은 PR로 판단하는 기준(diff 토큰 수, 파일 수, 노션 문서 토큰 수)
+ROUTING_SMALL_DIFF_TOKENS = int(os.getenv("ROUTING_SMALL_DIFF_TOKENS") or 2_000)
+ROUTING_SMALL_FILES = int(os.getenv("ROUTING_SMALL_FILES") or 3)
+ROUTING_SMALL_NOTION_TOKENS = int(os.getenv("ROUTING_SMALL_NOTION_TOKENS") or 4_000)
+# 요약 요청 하나에 담을 diff 의 최대 토큰 수
+SUMMARY_GROUP_TOKENS = int(os.getenv("SUMMARY_GROUP_TOKENS") or 20_000)
+# 동시에 실행할 요약 요청 수
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS") or 4)
+
+# base 커밋 fetch 방식: auto, full, shallow, partial
+GIT_FETCH_MODE = os.getenv("GIT_FETCH_MODE") or "auto"
+# 서비스별 초당 최대 요청 수. 429 응답을 받으면 일시적으로 낮췄다가 성공할 때마다 천천히 회복합니다.
+API_RATE_LIMITS = {
+    "github": float(os.getenv("GITHUB_RATE_LIMIT") or 10),
+    "notion": float(os.getenv("NOTION_RATE_LIMIT") or 3),
+    "openai": float(os.getenv("OPENAI_RATE_LIMIT") or 5),
+}
+# 429/5xx 응답 시 최대 재시도 횟수와 지수 백오프의 기본/최대 대기 시간 (초)
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES") or 5)
+API_RETRY_BASE_DELAY = 1.0
+API_RETRY_MAX_DELAY = 60.0
+# diff 줄 표기 방식 설명. 모든 요청에서 같은 문자열을 써야 프롬프트 캐시가 적용됩니다.
+PATCH_FORMAT_LEGEND = (
+    "Patch diffs list each file as `File: <path>` followed by its lines:\n"
+    "_L13+ : This line was added in the PR._\n"
+    "_L13- : This line was removed in the PR._\n"
+    "_L13 : This line was unchanged in the PR._\n"
+)
+# 접두사별 데이터 소스 정보 (JSON 문자열 또는 JSON 파일 경로). 설정하면 노션 검색을 생략합니다.
+NOTION_TASK_MAPPING = os.getenv("NOTION_TASK_MAPPING") or ""
+# 제목에서 "TASK-1234", "task 1234", "업무-12" 형태의 Task ID 후보를 찾는 정규식
+# TaskIdMatcher 처럼 접두사 글자를 제한하지 않도록 숫자, 밑줄, 한글 등 모든 단어 문자를 허용합니다.
+TASK_ID_CANDIDATE_PATTERN = re.compile(r"(\w+)[\-\s](\d+)")
+# 노션 블록 하위 목록을 동시에 조회할 최대 요청 수
+NOTION_EXPORT_WORKERS = int(os.getenv("NOTION_EXPORT_WORKERS") or 4)
+# 노션 문서 조회 한도. 0 이면 제한하지 않습니다.
+NOTION_MAX_DEPTH = int(os.getenv("NOTION_MAX_DEPTH") or 0)
+NOTION_MAX_BLOCKS = int(os.getenv("NOTION_MAX_BLOCKS") or 0)
+NOTION_MAX_TOKENS = int(os.getenv("NOTION_MAX_TOKENS") or MAX_PROMPT_TOKENS // 2)
+# 본문 작성에 도움이 되지 않아 조회하지 않는 블록 종류 (쉼표로 구분)
+NOTION_SKIP_BLOCK_TYPES = tuple(
+    block_type.strip()
+    for block_type in (
+        os.getenv("NOTION_SKIP_BLOCK_TYPES")
+        or "image,video,audio,file,pdf,embed,child_database"
+    ).split(",")
+    if block_type.strip()
+)
+# OpenAI Batch API 작업 상태 확인 주기 (초)
+OPENAI_BATCH_POLL_SECONDS = float(os.getenv("OPENAI_BATCH_POLL_SECONDS") or 60)
+
+_GIT_CONFIG_LOCK = threading.Lock()
+# 공유 미러 저장소의 clone/fetch 를 직렬화합니다.
+_MIRROR_LOCK = threading.Lock()
+# (블록 ID, last_edited_time) 별 하위 블록 목록. batch 모드에서 같은 페이지를 다시 조회하지 않습니다.
+_NOTION_CHILDREN_CACHE: dict[tuple[str, str], list[dict]] = {}
+_NOTION_CHILDREN_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    """
+    LLM 호출에 사용할 모델과 옵션입니다.
+    """
+    model: str
+    reasoning_effort: str | None = None
+    max_completion_tokens: int | None = None
+
+    def request_options(self) -> dict:
+        """
+        chat.completions.create 에 전달할 모델 관련 인자를 반환합니다.
+        """
+        options = {"model": self.model}
+        if self.reasoning_effort:
+            options["reasoning_effort"] = self.reasoning_effort
+        if self.max_completion_tokens:
+            options["max_completion_tokens"] = self.max_completion_tokens
+        return options
+
+
+@dataclass(frozen=True)
+class NotionExportLimits:
+    """
+    노션 문서를 프롬프트에 넣기 위해 조회할 블록 트리의 한도입니다.
+    한도는 조회 단계에서 적용되므로 노션 API 호출 수와 LLM 토큰을 함께 줄입니다.
+    """
+    # 페이지 바로 아래를 1로 하는 최대 깊이. 0 이면 제한 없음
+    max_depth: int = 0
+    # 최대 블록 수. 0 이면 제한 없음
+    max_blocks: int = 0
+    # 조회하지 않는 블록 종류
+    skip_types: tuple[str, ...] = ()
+    # 변환한 마크다운의 최대 토큰 수. 0 이면 제한 없음
+    max_tokens: int = 0
+
+
+NOTION_EXPORT_LIMITS = NotionExportLimits(
+    max_depth=NOTION_MAX_DEPTH,
+    max_blocks=NOTION_MAX_BLOCKS,
+    skip_types=NOTION_SKIP_BLOCK_TYPES,
+    max_tokens=NOTION_MAX_TOKENS,
+)
+
+# PR 본문 작성에 사용할 모델
+PR_MODEL = ModelConfig(
+    model=os.getenv("LLM_MODEL") or "o1",
+    reasoning_effort=os.getenv("LLM_REASONING_EFFORT") or None,
+    max_completion_tokens=int(os.getenv("LLM_MAX_TOKENS") or 0) or None,
+)
+SUMMARY_MODEL_CONFIG = ModelConfig(model=SUMMARY_MODEL)
+# 작은 PR에 사용할 저렴하고 빠른 모델
+SMALL_PR_MODEL = ModelConfig(model=os.getenv("SMALL_LLM_MODEL") or "gpt-4o-mini")
+
+
+class FakeOpenAI:
+    """
+    네트워크 없이 결정적인 응답을 돌려주는 OpenAI 클라이언트 대역입니다.
+    LLM_BACKEND=fake 로 LLM 을 제외한 나머지 파이프라인을 벤치마크할 때 사용합니다.
+    chat.completions.create 의 일반 응답과 stream=True 응답 형식을 흉내 냅니다.
+    files, batches 는 Batch API 흐름을 메모리 안에서 즉시 완료되는 작업으로 흉내 냅니다.
+    """
+    base_url = "fake://"
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self._files: dict[str, bytes] = {}
+        self._batches: dict[str, SimpleNamespace] = {}
+        self.files = SimpleNamespace(
+            create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(
+            create=self._create_batch, retrieve=self._batches.__getitem__)
+
+    @staticmethod
+    def _content(model: str, messages: list[dict]) -> str:
+        prompt = "".join(message["content"] for message in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        return (
+            f"## Summary\n"
+            f"Fake response from `{model}`.\n\n"
+            f"- Prompt characters: {len(prompt)}\n"
+            f"- Prompt digest: {digest}\n"
+        )
+
+    def _create(self, model: str, messages: list[dict], stream: bool = False, **kwargs):
+        content = self._content(model, messages)
+        usage = SimpleNamespace(
+            prompt_tokens=sum(count_tokens(message["content"]) for message in messages),
+            completion_tokens=count_tokens(content),
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0),
+        )
+        if not stream:
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                usage=usage,
+            )
+        chunks = [
+            SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=line))],
+                usage=None,
+            )
+            for line in content.splitlines(keepends=True)
+        ]
+        if (kwargs.get("stream_options") or {}).get("include_usage"):
+            chunks.append(SimpleNamespace(choices=[], usage=usage))
+        return _FakeStream(chunks)
+
+    def _create_file(self, file: tuple[str, bytes], purpose: str):
+        file_id = f"file-{len(self._files)}"
+        self._files[file_id] = file[1]
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        return SimpleNamespace(text=self._files[file_id].decode("utf-8"))
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str):
+        output_lines = []
+        for line in self._files[input_file_id].decode("utf-8").splitlines():
+            request = json.loads(line)
+            body = request["body"]
+            output_lines.append(json.dumps({
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {
+                        "content": self._content(body["model"], body["messages"])
+                    }}]},
+                },
+                "error": None,
+            }, ensure_ascii=False))
+        output_file = self._create_file(
+            ("output.jsonl", "\n".join(output_lines).encode("utf-8")), "batch_output")
+        batch = SimpleNamespace(
+            id=f"batch-{len(self._batches)}",
+            status="completed",
+            output_file_id=output_file.id,
+            error_file_id=None,
+        )
+        self._batches[batch.id] = batch
+        return batch
+
+
+class _FakeStream(list):
+    def close(self):
+        pass
+
+
+def create_llm_client() -> OpenAI:
+    """
+    LLM_BACKEND, LLM_BASE_URL 설정에 맞는 OpenAI 호환 클라이언트를 만듭니다.
+    """
+    if LLM_BACKEND == "fake":
+        return FakeOpenAI()
+    if LLM_BACKEND != "openai":
+        raise ValueError(f"Unknown LLM_BACKEND: {LLM_BACKEND}")
+    return OpenAI(
+        base_url=LLM_BASE_URL,
+        # 자체 호스팅 서버용 키. 없으면 OPENAI_API_KEY 를 사용합니다.
+        api_key=os.getenv("LLM_API_KEY") or None,
+        # 재시도는 공유 속도 제한과 함께 call_with_retry 가 담당합니다.
+        max_retries=0,
+    )
+
+
+@dataclass
+class Clients:
+    """
+    프로세스 전체에서 공유하는 API 클라이언트 묶음입니다.
+    각 클라이언트는 내부적으로 커넥션 풀(keep-alive)을 유지하므로,
+    전체 PR 처리 시 PR마다 새로 만들지 않고 재사용합니다.
+    """
+    github: Github
+    notion: NotionClient
+    openai: OpenAI
+    notion_token: str
+
+
+def create_clients(github_token: str, notion_token: str) -> Clients:
+    """
+    GitHub, 노션, OpenAI 클라이언트를 한 번만 생성합니다.
+    """
+    return Clients(
+        # PR 목록 조회 등 대부분의 GitHub 호출은 PyGithub 의 기본 재시도(보조 속도 제한, 5xx)를 사용합니다.
+        github=Github(auth=Auth.Token(github_token)),
+        # 노션 호출의 재시도는 공유 속도 제한과 함께 call_with_retry 가 담당하므로 클라이언트 자체 재시도는 끕니다.
+        # API version 2025-09-03을 사용하여 data_source 지원
+        notion=NotionClient(auth=notion_token, notion_version="2025-09-03", retry=False),
+        openai=create_llm_client(),
+        notion_token=notion_token,
+    )
+
+
+class RateLimiter:
+    """
+    스레드 간에 공유하는 토큰 버킷 속도 제한기입니다.
+    초당 rate 개의 토큰이 채워지고, 요청마다 토큰 하나를 소비합니다.
+
+    429 응답을 받으면 penalize 로 rate 를 절반으로 낮추고 Retry-After 동안 모든 스레드를 멈추며,
+    이후 성공할 때마다 설정한 최대 rate 까지 조금씩 되돌립니다.
+    """
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.rate = rate
+        self._tokens = max(rate, 1.0)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    max(self.rate, 1.0),
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(
+                    self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def penalize(self, delay: float):
+        with self._lock:
+            self.rate = max(self.rate / 2, 0.1)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def reward(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+
+RATE_LIMITERS = {service: RateLimiter(rate) for service, rate in API_RATE_LIMITS.items()}
+
+
+def _parse_retry_after(headers) -> float | None:
+    """
+    Retry-After 헤더(초 또는 HTTP 날짜)를 대기 시간(초)으로 변환합니다.
+    GitHub 의 기본 속도 제한은 x-ratelimit-reset 으로 대신 계산합니다.
+    """
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+    if headers.get("x-ratelimit-remaining") == "0" and headers.get("x-ratelimit-reset"):
+        return max(float(headers["x-ratelimit-reset"]) - time.time(), 0.0)
+    return None
+
+
+def _retry_info(error: Exception) -> tuple[bool, bool, float | None] | None:
+    """
+    재시도할 수 있는 오류인지 판단합니다.
+
+    Returns:
+        (재시도 가능 여부, 속도 제한 여부, Retry-After 초) 또는 None
+    """
+    # LLM_TIMEOUT 은 호출 전체의 한도이므로, 응답이 늦어 시간이 초과된 호출은 재시도하지 않습니다.
+    if isinstance(error, APITimeoutError):
+        return None
+    if isinstance(error, (APIConnectionError, RequestTimeoutError)):
+        return True, False, None
+    if isinstance(error, APIStatusError):
+        status, headers = error.status_code, error.response.headers
+    elif isinstance(error, HTTPResponseError):
+        status, headers = error.status, error.headers
+    elif isinstance(error, GithubException):
+        status, headers = error.status, error.headers
+    else:
+        return None
+    retry_after = _parse_retry_after(headers)
+    # GitHub 의 보조 속도 제한은 403 과 Retry-After 로 응답합니다.
+    rate_limited = status == 429 or (status == 403 and retry_after is not None)
+    return rate_limited or status >= 500, rate_limited, retry_after
+
+
+def call_with_retry(
+    service: str,
+    func: Callable,
+    *args,
+    idempotent: bool = True,
+    **kwargs
+):
+    """
+    서비스별 공유 속도 제한을 지키며 func 를 호출하고,
+    429/5xx 응답이나 연결 오류는 지수 백오프와 지터를 적용해 재시도합니다.
+    Retry-After 헤더가 있으면 그 시간만큼 기다립니다.
+
+    Args:
+        service (str): "github", "notion", "openai" 중 하나
+        func (Callable): 호출할 함수
+        idempotent (bool): False 이면 요청이 처리되었을 수 있는 5xx, 연결 오류는 재시도하지 않고
+            처리되지 않은 것이 확실한 429 만 재시도합니다. (Batch 작업 생성 등)
+    """
+    limiter = RATE_LIMITERS[service]
+    for attempt in range(API_MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            info = _retry_info(e)
+            if not info or not info[0] or attempt == API_MAX_RETRIES:
+                raise
+            _, rate_limited, retry_after = info
+            if not idempotent and not rate_limited:
+                raise
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** attempt))
+            if rate_limited:
+                limiter.penalize(delay)
+            print(f"[WARN] {service} 요청 실패({e.__class__.__name__}), "
+                  f"{delay:.1f}초 후 다시 시도합니다. ({attempt + 1}/{API_MAX_RETRIES})")
+            time.sleep(delay)
+        else:
+            limiter.reward()
+            return result
+
+
+def iter_notion_db_name_prefix_pages(notion: NotionClient) -> Iterator[list[dict]]:
+    """
+    연결된 노션 계정의 모든 데이터 소스를 페이지 단위로 조회하며
+    검색 결과 페이지마다 Unique ID 속성의 접두사 목록을 반환합니다.
+
+    next_cursor 를 따라가므로 데이터 소스가 100개를 넘어도 누락되지 않으며,
+    호출자는 원하는 접두사를 찾는 즉시 순회를 멈출 수 있습니다.
+
+    Args:
+        notion (NotionClient)
+
+    Yields:
+        extract_notion_db_name_prefixes 와 동일한 형식의 list
+    """
+    start_cursor = None
+    while True:
+        # Search API now returns data_source objects instead of database objects
+        kwargs = {
+            "filter": {
+                "value": "data_source",
+                "property": "object"
+            },
+            "page_size": 100,
+        }
+        if start_cursor:
+            kwargs["start_cursor"] = start_cursor
+        response = call_with_retry("notion", notion.search, **kwargs)
+
+        # select a property which type is unique_id and has a prefix
+        records = []
+        for data_source in response["results"]:
+            # Get the parent database_id from the data_source
+            parent = data_source.get("parent", {})
+            database_id = parent.get("database_id")
+
+            if not database_id:
+                continue
+
+            # Check properties for unique_id type
+            properties = data_source.get("properties", {})
+            for property in properties.values():
+                if property["type"] == "unique_id" and property["unique_id"].get("prefix"):
+                    records.append({
+                        "prefix": property["unique_id"]["prefix"],
+                        "database_id": database_id,
+                        "data_source_id": data_source["id"],
+                        "property_name": property["name"]
+                    })
+        yield records
+
+        start_cursor = response.get("next_cursor")
+        if not response.get("has_more") or not start_cursor:
+            break
+
 
 def extract_notion_db_name_prefixes(notion: NotionClient) -> list[dict]:
     """
@@ -53,36 +548,243 @@ def extract_notion_db_name_prefixes(notion: NotionClient) -> list[dict]:
             "property_name": "ID"
         }]
     """
-    # Search API now returns data_source objects instead of database objects
-    data_sources = notion.search(
-        filter={
-            "value": "data_source",
-            "property": "object"
-        }
-    )["results"]
-
-    # select a property which type is unique_id and has a prefix
-    result = []
-    for data_source in data_sources:
-        # Get the parent database_id from the data_source
-        parent = data_source.get("parent", {})
-        database_id = parent.get("database_id")
-        
-        if not database_id:
-            continue
-            
-        # Check properties for unique_id type
-        properties = data_source.get("properties", {})
-        for property in properties.values():
-            if property["type"] == "unique_id" and property["unique_id"].get("prefix"):
-                result.append({
-                    "prefix": property["unique_id"]["prefix"],
-                    "database_id": database_id,
-                    "data_source_id": data_source["id"],
-                    "property_name": property["name"]
-                })
-    
-    return result
+    return [
+        record
+        for records in iter_notion_db_name_prefix_pages(notion)
+        for record in records
+    ]
+
+
+def _write_json_atomic(path: str, data) -> None:
+    """
+    JSON 파일을 원자적으로 기록합니다.
+    동시에 실행되는 다른 프로세스가 깨진 파일을 읽지 않도록 임시 파일을 쓴 뒤 교체합니다.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _prefix_cache_path(notion_token: str) -> str:
+    """
+    노션 토큰의 해시값으로 접두사 캐시 파일 경로를 만듭니다.
+    토큰 원문은 디스크에 기록하지 않습니다.
+    """
+    token_hash = hashlib.sha256(notion_token.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, "notion_prefixes", f"{token_hash}.json")
+
+
+def _read_prefix_cache(notion_token: str) -> dict | None:
+    """
+    접두사 캐시 파일을 그대로 읽어옵니다. 파일이 없거나 깨졌으면 None 을 반환합니다.
+    """
+    try:
+        with open(_prefix_cache_path(notion_token), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_cached_prefixes(notion_token: str, ttl: int = NOTION_PREFIX_CACHE_TTL) -> list[dict] | None:
+    """
+    디스크에 저장된 노션 데이터베이스 접두사 목록을 읽어옵니다.
+
+    Args:
+        notion_token (str): 노션 API 토큰
+        ttl (int): 캐시 유효 시간(초)
+
+    Returns:
+        캐시된 접두사 목록 또는 None (캐시가 없거나 만료된 경우)
+    """
+    cached = _read_prefix_cache(notion_token)
+    if cached is None:
+        return None
+
+    if time.time() - cached.get("created_at", 0) > ttl:
+        return None
+    return cached.get("prefixes")
+
+
+def save_cached_prefixes(notion_token: str, prefixes: list[dict], complete: bool = True):
+    """
+    노션 데이터베이스 접두사 목록을 디스크에 저장합니다.
+    캐시 저장 실패는 본 작업에 영향을 주지 않도록 경고만 출력합니다.
+
+    Args:
+        notion_token (str): 노션 API 토큰
+        prefixes (list[dict]): 접두사 목록
+        complete (bool): 모든 데이터 소스를 조회한 목록인지 여부
+    """
+    path = _prefix_cache_path(notion_token)
+    try:
+        _write_json_atomic(path, {
+            "created_at": time.time(),
+            "complete": complete,
+            "prefixes": prefixes,
+        })
+    except OSError as e:
+        print(f"[WARN] Failed to write Notion prefix cache: {e}")
+
+
+def can_refresh_prefixes(
+    notion_token: str,
+    interval: int = NOTION_PREFIX_REFRESH_INTERVAL
+) -> bool:
+    """
+    캐시에 없는 접두사를 찾기 위해 전체 검색을 다시 해도 되는지 판단합니다.
+
+    일치하는 접두사를 찾는 즉시 검색을 멈춘 캐시는 일부만 저장되어 있으므로 바로 다시 검색하고,
+    모든 데이터 소스를 조회한 캐시는 마지막 조회 후 interval 초가 지난 경우에만 다시 검색합니다.
+    "Python 3", "issue 42" 처럼 Task ID가 아닌 제목 때문에 매 실행마다 검색하지 않기 위함입니다.
+    """
+    cached = _read_prefix_cache(notion_token)
+    if cached is None or not cached.get("complete", False):
+        return True
+    return time.time() - cached.get("created_at", 0) > interval
+
+
+def invalidate_cached_prefixes(notion_token: str):
+    """
+    노션 데이터베이스 접두사 캐시를 삭제합니다.
+    """
+    try:
+        os.remove(_prefix_cache_path(notion_token))
+    except FileNotFoundError:
+        pass
+
+
+def _page_cache_path(page_id: str) -> str:
+    """
+    노션 페이지 마크다운 캐시 파일 경로를 만듭니다.
+    """
+    return os.path.join(CACHE_DIR, "notion_pages", f"{page_id}.json")
+
+
+def load_cached_page_markdown(page: dict) -> str | None:
+    """
+    디스크에 저장된 노션 페이지 마크다운을 읽어옵니다.
+    페이지가 저장 이후 수정되었으면(last_edited_time 이 다르면) 사용하지 않습니다.
+
+    Args:
+        page (dict): search_page 가 반환한 페이지 객체
+
+    Returns:
+        캐시된 마크다운 또는 None
+    """
+    try:
+        with open(_page_cache_path(page["id"]), encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("last_edited_time") != page.get("last_edited_time"):
+        return None
+    # 조회 한도가 바뀌면 같은 페이지라도 결과가 다르므로 다시 변환합니다.
+    if cached.get("limits") != repr(NOTION_EXPORT_LIMITS):
+        return None
+    return cached.get("markdown")
+
+
+def save_cached_page_markdown(page: dict, markdown: str):
+    """
+    노션 페이지 마크다운을 페이지의 last_edited_time 과 함께 디스크에 저장합니다.
+
+    last_edited_time 은 분 단위로 기록되어 같은 분 안의 수정은 시각을 바꾸지 않으므로,
+    NOTION_PAGE_CACHE_MIN_AGE 초 안에 수정된 페이지는 아직 편집 중일 수 있어 저장하지 않습니다.
+    """
+    if not page.get("last_edited_time"):
+        return
+    try:
+        edited_at = datetime.datetime.fromisoformat(page["last_edited_time"].replace("Z", "+00:00"))
+    except ValueError:
+        return
+    age = datetime.datetime.now(datetime.timezone.utc) - edited_at
+    if age.total_seconds() < NOTION_PAGE_CACHE_MIN_AGE:
+        return
+    try:
+        _write_json_atomic(_page_cache_path(page["id"]), {
+            "last_edited_time": page["last_edited_time"],
+            "limits": repr(NOTION_EXPORT_LIMITS),
+            "markdown": markdown,
+        })
+    except OSError as e:
+        print(f"[WARN] Failed to write Notion page cache: {e}")
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    단어 목록을 공통 접두사끼리 묶은 정규식으로 만듭니다.
+    예: ["TASK", "TASKS", "TEST"] → "T(?:ASK(?:S)?|EST)"
+
+    단순한 "TASK|TASKS|TEST" 와 달리 앞 글자가 같은 접두사를 한 번만 비교하고,
+    짧은 접두사가 긴 접두사를 가리지 않도록 항상 가장 긴 접두사부터 시도합니다.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # 여기서 끝나는 접두사가 있으면 나머지는 선택적으로 매칭합니다.
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class TaskIdMatcher:
+    """
+    접두사 목록으로 한 번만 컴파일해 두고 여러 문자열에서 Task ID를 찾는 matcher 입니다.
+    PR 제목뿐 아니라 브랜치 이름, 커밋 메시지에도 그대로 사용할 수 있습니다.
+    같은 접두사 목록의 matcher 는 get_task_id_matcher 로 재사용합니다.
+    """
+
+    def __init__(self, prefixes: Iterable[str]):
+        self.prefixes = frozenset(prefix.upper() for prefix in prefixes if prefix)
+        self.pattern = re.compile(
+            "(" + _trie_pattern(self.prefixes) + r")[\-\s](\d+)", re.IGNORECASE
+        ) if self.prefixes else None
+
+    def find_all(self, text: str) -> list[str]:
+        """
+        문자열에 나오는 모든 Task ID를 나온 순서대로 중복 없이 반환합니다.
+        """
+        if not self.pattern or not text:
+            return []
+        task_ids = {}
+        for match in self.pattern.finditer(text):
+            task_ids.setdefault(f"{match.group(1).upper()}-{match.group(2)}", None)
+        return list(task_ids)
+
+    def search(self, text: str) -> str | None:
+        """
+        문자열에서 처음 나오는 Task ID를 반환합니다.
+        """
+        if not self.pattern or not text:
+            return None
+        match = self.pattern.search(text)
+        if match:
+            return f"{match.group(1).upper()}-{match.group(2)}"  # 예: TASK-1234
+        return None
+
+
+@functools.lru_cache(maxsize=128)
+def get_task_id_matcher(prefixes: frozenset[str]) -> TaskIdMatcher:
+    """
+    접두사 집합별로 컴파일한 TaskIdMatcher 를 재사용합니다.
+    """
+    return TaskIdMatcher(prefixes)
 
 
 def extract_dynamic_task_id(title: str, prefixes: list[str]) -> str | None:
@@ -97,255 +799,1673 @@ def extract_dynamic_task_id(title: str, prefixes: list[str]) -> str | None:
         추출된 Task ID 또는 None
     """
     # None 또는 빈 값이 포함될 수 있으므로 필터링한다
-    valid_prefixes = [p for p in prefixes if p]
-    if not valid_prefixes:
+    return get_task_id_matcher(frozenset(p for p in prefixes if p)).search(title)
+
+
+def build_prefix_index(prefix_records: Iterable[dict]) -> dict[str, dict]:
+    """
+    접두사 정보를 대문자 접두사 → 접두사 정보의 dict 로 만듭니다.
+    같은 접두사가 여러 번 나오면 처음 것을 사용합니다.
+    """
+    index = {}
+    for record in prefix_records:
+        if record.get("prefix"):
+            index.setdefault(record["prefix"].upper(), record)
+    return index
+
+
+def lookup_task_id(title: str, index: dict[str, dict]) -> tuple[str, dict] | None:
+    """
+    index 의 접두사로 컴파일한 matcher 로 PR 제목에서 Task ID를 찾고,
+    일치한 접두사의 정보를 dict 에서 바로 가져옵니다.
+
+    Args:
+        title (str): PR 제목
+        index (dict[str, dict]): build_prefix_index 의 결과
+
+    Returns:
+        (Task ID, 일치한 접두사 정보) 또는 None
+    """
+    task_id = get_task_id_matcher(frozenset(index)).search(title)
+    if not task_id:
         return None
+    return task_id, index[task_id.rsplit("-", 1)[0]]
 
-    # 접두사를 포함한 정규식을 동적으로 생성
-    pattern = r"(" + "|".join(re.escape(prefix) for prefix in valid_prefixes) + r")[\-\s](\d+)"
-    match = re.search(pattern, title, re.IGNORECASE)
-    if match:
-        return f"{match.group(1).upper()}-{match.group(2)}"  # 예: TASK-1234
-    return None
+
+def resolves_first_candidate(title: str, index: dict[str, dict]) -> bool:
+    """
+    index 의 접두사로 찾은 Task ID가 제목의 첫 번째 Task ID 후보 자체인지 확인합니다.
+
+    그렇다면 아직 조회하지 않은 접두사가 있어도 그 앞에서 일치할 수 없으므로,
+    전체 접두사로 찾은 결과와 같습니다.
+    """
+    pattern = get_task_id_matcher(frozenset(index)).pattern
+    candidate = TASK_ID_CANDIDATE_PATTERN.search(title)
+    match = pattern.search(title) if pattern else None
+    return bool(match and candidate and match.span() == candidate.span())
+
+
+@functools.lru_cache(maxsize=None)
+def load_static_prefix_index(mapping: str = NOTION_TASK_MAPPING) -> dict[str, dict]:
+    """
+    NOTION_TASK_MAPPING 에 설정한 접두사 → 데이터 소스 정보를 읽어 index 를 만듭니다.
+
+    mapping 은 JSON 문자열이나 JSON 파일 경로이며, 형식은 다음과 같습니다.
+        {"TASK": {"data_source_id": "...", "property_name": "ID"}}
+
+    설정을 읽을 수 없거나 data_source_id, property_name 이 없는 항목은
+    경고를 출력하고 제외하므로, 해당 접두사는 노션 검색으로 찾습니다.
+
+    Returns:
+        build_prefix_index 형식의 dict (설정이 없으면 빈 dict)
+    """
+    if not mapping:
+        return {}
+    try:
+        if mapping.lstrip().startswith("{"):
+            data = json.loads(mapping)
+        else:
+            with open(mapping, encoding="utf-8") as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Failed to load NOTION_TASK_MAPPING: {e}")
+        return {}
+    if not isinstance(data, dict):
+        print("[WARN] NOTION_TASK_MAPPING must be a JSON object.")
+        return {}
+
+    records = []
+    for prefix, record in data.items():
+        if not isinstance(record, dict) or not all(
+            isinstance(record.get(key), str) and record.get(key)
+            for key in ("data_source_id", "property_name")
+        ):
+            print(f"[WARN] Ignoring NOTION_TASK_MAPPING entry {prefix!r}: "
+                  "data_source_id and property_name are required.")
+            continue
+        records.append({"prefix": prefix, **record})
+    return build_prefix_index(records)
+
+
+def find_notion_task(
+    notion: NotionClient,
+    notion_token: str,
+    title: str,
+    refresh: bool = False
+) -> tuple[str, dict] | None:
+    """
+    PR 제목에 해당하는 Task ID와 노션 데이터 소스 정보를 찾습니다.
+
+    캐시가 유효하면 노션 검색 없이 캐시만 사용합니다.
+    그렇지 않으면 검색 결과 페이지마다 지금까지 조회한 모든 접두사로 제목을 다시 확인하고,
+    제목의 첫 번째 Task ID 후보가 확정되면 멈춘 뒤 그때까지 조회한 접두사를 캐시에 저장합니다.
+    캐시를 사용할 때와 같은 규칙(제목에서 가장 앞에 나오는 Task ID)으로 찾기 위함입니다.
+    (캐시에서 찾지 못한 경우에는 호출자가 can_refresh_prefixes 를 확인한 뒤 refresh=True 로 다시 조회합니다.)
+
+    Args:
+        notion (NotionClient)
+        notion_token (str): 캐시 키로 사용할 노션 API 토큰
+        title (str): PR 제목
+        refresh (bool): True 이면 캐시를 무시하고 새로 검색합니다.
+
+    Returns:
+        (Task ID, 일치한 접두사 정보) 또는 None
+    """
+    if not refresh:
+        cached = load_cached_prefixes(notion_token)
+        if cached is not None:
+            # 캐시된 전체 접두사로 컴파일한 matcher 로 한 번에 찾습니다.
+            index = build_prefix_index(cached)
+            found = lookup_task_id(title, index)
+            # 일부만 저장된 캐시에서는 더 앞에 나오는 후보가 아직 조회하지 않은 접두사일 수 있습니다.
+            if not found or resolves_first_candidate(title, index) or \
+                    (_read_prefix_cache(notion_token) or {}).get("complete", False):
+                print("노션 데이터베이스 접두사를 캐시에서 불러왔습니다.")
+                return found
+
+    seen = []
+    complete = True
+    for records in iter_notion_db_name_prefix_pages(notion):
+        seen += records
+        if resolves_first_candidate(title, build_prefix_index(seen)):
+            complete = False
+            break
+    save_cached_prefixes(notion_token, seen, complete=complete)
+    return lookup_task_id(title, build_prefix_index(seen))
+
+
+def search_page(notion: NotionClient, data_source_id: str, property_name: str, number: int) -> dict | None:
+    """
+    노션 페이지를 검색해옵니다.
+
+    Args:
+        notion (NotionClient)
+        data_source_id (str): 노션 데이터 소스 ID
+        property_name (str): Task ID를 저장하는 속성 이름
+        number (int): 노션 페이지의 Task ID
+
+    Returns:
+        노션 페이지의 정보 또는 None
+    """
+    # API version 2025-09-03: databases.query is now data_sources.query
+    # Using request method directly for compatibility with notion-client library
+    response = call_with_retry(
+        "notion",
+        notion.request,
+        path=f"data_sources/{data_source_id}/query",
+        method="POST",
+        body={
+            "filter": {
+                "property": property_name,
+                "unique_id": {
+                    "equals": number
+                }
+            }
+        }
+    )
+
+    results = response.get("results", [])
+    if not results:
+        return None
+    return results[0]  # 첫 번째 매칭된 페이지 반환
+
+
+def fetch_block_children(notion: NotionClient, block: dict) -> list[dict]:
+    """
+    블록의 하위 블록 목록을 next_cursor 를 따라가며 모두 조회합니다.
+    같은 블록이 마지막 수정 이후 이미 조회되었으면 메모리 캐시를 사용합니다.
+
+    Args:
+        notion (NotionClient)
+        block (dict): 페이지 또는 블록 객체 (id, last_edited_time 포함)
+
+    Returns:
+        하위 블록 목록
+    """
+    key = (block["id"], block.get("last_edited_time") or "")
+    with _NOTION_CHILDREN_LOCK:
+        cached = _NOTION_CHILDREN_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    children = []
+    start_cursor = None
+    while True:
+        kwargs = {"block_id": block["id"], "page_size": 100}
+        if start_cursor:
+            kwargs["start_cursor"] = start_cursor
+        response = call_with_retry("notion", notion.blocks.children.list, **kwargs)
+        children += response["results"]
+        if not response.get("has_more"):
+            break
+        start_cursor = response["next_cursor"]
+
+    with _NOTION_CHILDREN_LOCK:
+        _NOTION_CHILDREN_CACHE[key] = children
+    return children
+
+
+def _render_rich_text(rich_text: list[dict]) -> str:
+    """
+    노션 rich text 배열을 마크다운 인라인 텍스트로 변환합니다.
+    """
+    parts = []
+    for item in rich_text:
+        text = item.get("plain_text", "")
+        if item.get("type") == "equation":
+            text = f"${text}$"
+        elif text.strip():
+            annotations = item.get("annotations") or {}
+            if annotations.get("code"):
+                text = f"`{text}`"
+            if annotations.get("bold"):
+                text = f"**{text}**"
+            if annotations.get("italic"):
+                text = f"*{text}*"
+            if annotations.get("strikethrough"):
+                text = f"~~{text}~~"
+            if item.get("href"):
+                text = f"[{text}]({item['href']})"
+        parts.append(text)
+    return "".join(parts)
+
+
+def _render_block(block: dict, children_map: dict[str, list[dict]], number: int) -> str:
+    """
+    블록 하나와 그 하위 블록을 마크다운으로 변환합니다.
+
+    Args:
+        block (dict): 노션 블록
+        children_map (dict[str, list[dict]]): 블록 ID 별 하위 블록 목록
+        number (int): 번호 목록 항목의 순번
+    """
+    block_type = block["type"]
+    value = block.get(block_type) or {}
+    text = _render_rich_text(value.get("rich_text", []))
+    children = _render_blocks(children_map.get(block["id"], []), children_map)
+
+    if block_type == "paragraph":
+        line = text
+    elif block_type in ("heading_1", "heading_2", "heading_3"):
+        line = "#" * int(block_type[-1]) + f" {text}"
+    elif block_type == "bulleted_list_item":
+        line = f"- {text}"
+    elif block_type == "numbered_list_item":
+        line = f"{number}. {text}"
+    elif block_type == "to_do":
+        line = f"- [{'x' if value.get('checked') else ' '}] {text}"
+    elif block_type == "toggle":
+        line = f"- {text}"
+    elif block_type in ("quote", "callout"):
+        line = f"> {text}"
+    elif block_type == "code":
+        return f"```{value.get('language', '')}\n{text}\n```"
+    elif block_type == "equation":
+        return f"$$\n{value.get('expression', '')}\n$$"
+    elif block_type == "divider":
+        return "---"
+    elif block_type == "table":
+        rows = children_map.get(block["id"], [])
+        lines = []
+        for index, row in enumerate(rows):
+            cells = [_render_rich_text(cell) for cell in row["table_row"]["cells"]]
+            lines.append("| " + " | ".join(cells) + " |")
+            if index == 0:
+                lines.append("|" + " --- |" * len(cells))
+        return "\n".join(lines)
+    elif block_type in ("child_page", "child_database"):
+        return f"[{value.get('title', '')}]"
+    elif block_type in ("image", "video", "file", "pdf", "audio"):
+        url = (value.get(value.get("type", "")) or {}).get("url", "")
+        caption = _render_rich_text(value.get("caption", []))
+        return f"![{caption}]({url})"
+    elif block_type in ("bookmark", "embed", "link_preview"):
+        return f"[{value.get('url', '')}]({value.get('url', '')})"
+    else:
+        # column_list, column, synced_block 등은 하위 블록만 출력합니다.
+        return children
+
+    if not children:
+        return line
+    # 목록, 토글 등의 하위 블록은 들여써서 이어 붙입니다.
+    indented = "\n".join(f"  {child}" if child else child for child in children.split("\n"))
+    return f"{line}\n{indented}"
+
+
+def _render_blocks(blocks: list[dict], children_map: dict[str, list[dict]]) -> str:
+    """
+    같은 부모 아래의 블록 목록을 마크다운으로 변환합니다.
+    """
+    rendered = []
+    number = 0
+    previous_type = None
+    for block in blocks:
+        number = number + 1 if block["type"] == "numbered_list_item" else 0
+        markdown = _render_block(block, children_map, number)
+        if not markdown:
+            continue
+        # 연속된 목록 항목은 빈 줄 없이 이어 붙입니다.
+        if rendered and block["type"] == previous_type and block["type"] in _LIST_BLOCK_TYPES:
+            rendered[-1] += f"\n{markdown}"
+        else:
+            rendered.append(markdown)
+        previous_type = block["type"]
+    return "\n\n".join(rendered)
+
+
+_LIST_BLOCK_TYPES = ("bulleted_list_item", "numbered_list_item", "to_do", "toggle")
+
+
+def export_notion_page(
+    notion: NotionClient,
+    page: dict,
+    workers: int = NOTION_EXPORT_WORKERS,
+    limits: NotionExportLimits = NOTION_EXPORT_LIMITS
+) -> str:
+    """
+    노션 페이지의 블록 트리를 마크다운으로 변환합니다.
+
+    블록 트리를 깊이 단위로 내려가며 같은 깊이의 하위 블록 목록은 최대 workers 개씩 동시에 조회하므로,
+    블록을 하나씩 조회하던 notion2md 보다 긴 문서에서 훨씬 빠릅니다.
+    하위 페이지와 데이터베이스는 제목만 남기고 내부는 조회하지 않습니다.
+
+    limits 의 최대 깊이, 최대 블록 수, 토큰 예산에 도달하면 더 깊은 블록은 조회하지 않고,
+    skip_types 에 해당하는 블록(이미지, 임베드 등)은 버립니다.
+
+    Args:
+        notion (NotionClient)
+        page (dict): search_page 가 반환한 페이지 객체
+        workers (int): 동시에 조회할 최대 요청 수
+        limits (NotionExportLimits): 조회 한도
+
+    Returns:
+        페이지 본문 마크다운
+    """
+    children_map: dict[str, list[dict]] = {}
+    level = [page]
+    depth = 0
+    block_count = 0
+    token_count = 0
+    with ThreadPoolExecutor(max_workers=workers, initializer=inherit_output_buffer()) as executor:
+        while level:
+            depth += 1
+            results = executor.map(lambda block: fetch_block_children(notion, block), level)
+            next_level = []
+            for block, children in zip(level, results):
+                children = [
+                    child for child in children
+                    if child["type"] not in limits.skip_types
+                ]
+                if limits.max_blocks:
+                    children = children[:max(limits.max_blocks - block_count, 0)]
+                block_count += len(children)
+                children_map[block["id"]] = children
+                for child in children:
+                    value = child.get(child["type"]) or {}
+                    token_count += count_tokens(
+                        _render_rich_text(value.get("rich_text", [])))
+                next_level += [
+                    child for child in children
+                    if child.get("has_children")
+                    and child["type"] not in ("child_page", "child_database")
+                ]
+            if next_level and (
+                (limits.max_depth and depth >= limits.max_depth)
+                or (limits.max_blocks and block_count >= limits.max_blocks)
+                or (limits.max_tokens and token_count >= limits.max_tokens)
+            ):
+                print(f"[WARN] Notion export stopped at depth {depth} "
+                      f"({block_count} blocks, ~{token_count} tokens).")
+                break
+            level = next_level
+
+    markdown = _render_blocks(children_map[page["id"]], children_map)
+    if limits.max_tokens:
+        markdown = truncate_to_tokens(markdown, limits.max_tokens)
+    return markdown
+
+
+def _run_git(args: list[str], cwd: str | None = None) -> str:
+    """
+    git 명령을 실행하고 표준 출력을 반환합니다. 실패하면 RuntimeError 를 발생시킵니다.
+    """
+    result = subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Failed to run git {args[0]}. Return code: {result.returncode}\n"
+            f"stderr: {result.stderr}"
+        )
+    return result.stdout
+
+
+def _has_commit(git_dir: str, sha: str) -> bool:
+    """
+    git_dir 저장소에 해당 커밋 객체가 이미 있는지 확인합니다.
+    """
+    result = subprocess.run(
+        ["git", "cat-file", "-e", f"{sha}^{{commit}}"],
+        cwd=git_dir,
+        capture_output=True,
+        check=False
+    )
+    return result.returncode == 0
+
+
+def _fetch_options(git_dir: str, fetch_mode: str) -> list[str]:
+    """
+    fetch_mode 에 맞는 git fetch 옵션을 반환합니다.
+
+    - full: 전체 히스토리를 가져옵니다. (기존 동작)
+    - shallow: 필요한 커밋만 depth 1 로 가져옵니다.
+    - partial: shallow 에 더해 blob 을 제외하고 가져오며,
+      git diff 가 변경된 경로의 blob 만 필요할 때 가져옵니다.
+    - auto: 저장소가 shallow 이면 shallow, 아니면 full 로 동작합니다.
+    """
+    if fetch_mode == "auto":
+        is_shallow = _run_git(
+            ["rev-parse", "--is-shallow-repository"], cwd=git_dir).strip()
+        fetch_mode = "shallow" if is_shallow == "true" else "full"
+
+    if fetch_mode == "full":
+        return []
+    if fetch_mode == "shallow":
+        return ["--depth=1", "--no-tags"]
+    if fetch_mode == "partial":
+        return ["--depth=1", "--no-tags", "--filter=blob:none"]
+    raise ValueError(f"Unknown GIT_FETCH_MODE: {fetch_mode}")
+
+
+def _prepare_git_diff(
+    pr: PullRequest,
+    git_dir: str,
+    context_lines: int,
+    head_sha: str | None,
+    fetch_mode: str,
+    base_sha: str | None = None
+) -> list[str]:
+    """
+    diff 에 필요한 커밋을 준비하고 실행할 git diff 명령을 반환합니다.
+    base_sha 가 없으면 PR의 base 커밋과 비교합니다.
+
+    head_sha 가 주어지면 작업 트리 대신 객체 데이터베이스만으로 base..head 를 비교하므로
+    체크아웃이 필요 없고, 하나의 저장소(bare 포함)에서 여러 PR을 동시에 diff 할 수 있습니다.
+    head_sha 가 None 이면 작업 트리와 비교합니다.
+    """
+    base_sha = base_sha or pr.base.sha
+    # GHA에서는 1001 사용자로 checkout 해주지만
+    # Docker 사용자는 root 로 하길 권장합니다.
+    # 따라서 safe.directory 설정이 필요합니다.
+    # 그렇지 않으면 get diff 에서 not a git repository 에러가 발생합니다.
+    # 병렬 처리 시 ~/.gitconfig 잠금 충돌을 피하기 위해 직렬화합니다.
+    with _GIT_CONFIG_LOCK:
+        result = subprocess.run(
+            ['git', 'config', '--global', '--add', 'safe.directory', git_dir],
+            capture_output=True,
+            text=True,
+            check=False
+        )
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Failed to run git config. Return code: {result.returncode}\n"
+            f"stderr: {result.stderr}"
+        )
+
+    print(f"base sha: {base_sha}")
+    # 이미 있는 객체는 다시 fetch 하지 않습니다.
+    missing = [
+        sha for sha in (base_sha, head_sha)
+        if sha and not _has_commit(git_dir, sha)
+    ]
+    if missing:
+        result = subprocess.run(
+            [
+                'git',
+                'fetch',
+                *_fetch_options(git_dir, fetch_mode),
+                'origin',
+                *missing,
+            ],
+            capture_output=True,
+            text=True,
+            check=False,
+            cwd=git_dir
+        )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"Failed to run git fetch. Return code: {result.returncode}\n"
+                f"stderr: {result.stderr}"
+            )
+
+    diff_range = [base_sha, head_sha] if head_sha else [base_sha]
+    return [
+        "git",
+        "--no-pager",
+        "diff",
+        f"--unified={context_lines}",
+        *diff_range,
+    ]
+
+
+def _iter_patched_files(
+    diff_command: list[str],
+    git_dir: str,
+    max_diff_bytes: int,
+    max_total_bytes: int
+) -> Iterator[tuple[str, PatchedFile, str | None]]:
+    """
+    준비된 git diff 명령의 출력을 한 줄씩 읽으며 파일 단위로 파싱해 반환합니다.
+
+    전체 diff 를 하나의 문자열로 만들지 않고, 파일의 hunk 가 max_diff_bytes 를 넘거나
+    지금까지 읽은 hunk 의 합이 max_total_bytes 를 넘는 순간 나머지 줄은 버리므로
+    diff 크기와 관계없이 메모리 사용량이 일정하게 유지됩니다.
+    한도를 넘긴 hunk 는 한도 안에 들어가는 앞쪽 줄만 남기고 hunk 헤더의 줄 수를 그에 맞게 고칩니다.
+    전체 한도를 다 쓴 뒤의 파일은 헤더만 읽어 경로만 반환합니다.
+
+    Returns:
+        (경로, PatchedFile, note) 의 iterator
+        note 는 hunk 가 잘렸으면 "Truncated", 전체 한도 때문에 hunk 를 읽지 않았으면 "Omitted" 입니다.
+    """
+    def parse_file(header: list[str], body: list[str], note: str | None):
+        patched_file = PatchSet("".join(header + body))[0]
+        return patched_file.path, patched_file, note
+
+    with tempfile.TemporaryFile() as stderr, subprocess.Popen(
+        diff_command,
+        cwd=git_dir,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        text=True,
+        errors="replace"
+    ) as process:
+        header, body, body_bytes, note = [], [], 0, None
+        in_header, hunk_start, total_bytes = False, 0, 0
+        for line in process.stdout:
+            if line.startswith("diff --git "):
+                if header:
+                    yield parse_file(header, body, note)
+                header, body, body_bytes = [line], [], 0
+                note = "Omitted" if total_bytes >= max_total_bytes else None
+                in_header, hunk_start = True, 0
+            elif in_header and not line.startswith("@@"):
+                header.append(line)
+            elif note is None:
+                in_header = False
+                if line.startswith("@@"):
+                    hunk_start = len(body)
+                body.append(line)
+                line_bytes = len(line.encode("utf-8"))
+                body_bytes += line_bytes
+                total_bytes += line_bytes
+                if body_bytes > max_diff_bytes or total_bytes > max_total_bytes:
+                    # 한도를 넘긴 hunk 는 마지막 줄을 빼고 들어간 줄까지만 남깁니다.
+                    total_bytes -= line_bytes
+                    body = body[:hunk_start] + _shorten_hunk(body[hunk_start:-1])
+                    note = "Truncated" if body else "Omitted"
+            else:
+                in_header = False
+        if header:
+            yield parse_file(header, body, note)
+
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(
+                f"Failed to run git diff. Return code: {process.returncode}\n"
+                f"stderr: {stderr.read().decode('utf-8', errors='replace')}"
+            )
+
+
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@(.*)$", re.DOTALL)
+
+
+def _shorten_hunk(hunk_lines: list[str]) -> list[str]:
+    """
+    앞쪽 줄만 남긴 hunk 의 헤더를 남은 줄 수에 맞게 고쳐 unidiff 로 파싱할 수 있게 합니다.
+    헤더 외에 남은 줄이 없으면 빈 목록을 반환합니다.
+    """
+    match = HUNK_HEADER_PATTERN.match(hunk_lines[0]) if hunk_lines else None
+    if not match or len(hunk_lines) < 2:
+        return []
+    body = hunk_lines[1:]
+    source_count = sum(1 for line in body if line[:1] in (" ", "-"))
+    target_count = sum(1 for line in body if line[:1] in (" ", "+"))
+    header = (
+        f"@@ -{match.group(1)},{source_count} "
+        f"+{match.group(2)},{target_count} @@{match.group(3)}"
+    )
+    return [header] + body
+
+
+# LLM 에 보낼 필요가 없는 lock 파일과 생성된 파일
+LOCK_FILE_NAMES = {
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "bun.lockb",
+    "poetry.lock", "Pipfile.lock", "uv.lock", "Cargo.lock", "Gemfile.lock",
+    "composer.lock", "go.sum", "Podfile.lock", "pubspec.lock",
+}
+GENERATED_FILE_PATTERNS = [
+    "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py", "*_pb2.pyi",
+    "*.generated.*", "*.snap",
+]
+
+
+def get_diff_numstat(diff_command: list[str], git_dir: str) -> list[dict]:
+    """
+    전체 diff 를 만들기 전에 'git diff --numstat' 으로 파일별 변경 줄 수만 가져옵니다.
+
+    Returns:
+        [{"path": "a.py", "paths": ["a.py"], "added": 3, "deleted": 1}]
+        바이너리 파일은 added, deleted 가 None 입니다.
+        이름이 바뀐 파일은 paths 에 이전 경로와 새 경로가 모두 들어갑니다.
+    """
+    command = diff_command[:3] + ["--numstat", "-z"] + diff_command[3:]
+    fields = _run_git(command[1:], cwd=git_dir).split("\0")
+
+    entries = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        added, deleted, path = fields[i].split("\t", 2)
+        i += 1
+        if path:
+            paths = [path]
+        else:
+            # 이름 변경: "added\tdeleted\t\0old\0new\0"
+            paths = [fields[i], fields[i + 1]]
+            i += 2
+        entries.append({
+            "path": paths[-1],
+            "paths": paths,
+            "added": None if added == "-" else int(added),
+            "deleted": None if deleted == "-" else int(deleted),
+        })
+    return entries
+
+
+def classify_changed_file(entry: dict) -> str | None:
+    """
+    get_diff_numstat 의 항목을 보고 전체 diff 를 가져올 필요가 없는 파일이면 그 이유를 반환합니다.
+    큰 파일은 걸러내지 않고 collect_file_diffs 와 pack_file_diffs 가 잘라 씁니다.
+
+    Returns:
+        "Binary", "Lock File", "Generated" 중 하나 또는 None
+    """
+    name = os.path.basename(entry["path"])
+    if entry["added"] is None:
+        return "Binary"
+    if name in LOCK_FILE_NAMES:
+        return "Lock File"
+    if any(fnmatch.fnmatch(name, pattern) for pattern in GENERATED_FILE_PATTERNS):
+        return "Generated"
+    return None
+
+
+def _format_hunk(hunk) -> str:
+    """
+    하나의 hunk 를 LLM 에 전달할 "L13+ : ..." 형식의 텍스트로 변환합니다.
+    """
+    hunk_lines = []
+    for line in hunk:
+        if line.is_added:
+            hunk_lines.append(
+                f"L{line.target_line_no}+ : {line.value.rstrip()}"
+            )
+        elif line.is_removed:
+            hunk_lines.append(
+                f"L{line.source_line_no}- : {line.value.rstrip()}"
+            )
+        else:
+            hunk_lines.append(
+                f"L{line.source_line_no} : {line.value.rstrip()}"
+            )
+    return "\n".join(hunk_lines)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    토큰 수 계산에 사용할 tiktoken 인코딩을 불러옵니다.
+    인코딩 파일을 내려받을 수 없는 환경에서는 None 을 반환하고 근사치를 사용합니다.
+    """
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        print(f"[WARN] Failed to load tokenizer, falling back to estimation: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    텍스트의 토큰 수를 계산합니다.
+    토크나이저가 없으면 utf-8 3바이트당 1토큰으로 보수적으로 추정합니다.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text.encode("utf-8")) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    텍스트를 최대 max_tokens 토큰 길이로 자릅니다.
+    max_tokens 가 0 이하이면 생략 표시만 반환합니다.
+    """
+    if max_tokens <= 0:
+        return "... [Truncated]" if text else text
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is None:
+        truncated = text.encode("utf-8")[:max_tokens * 3].decode("utf-8", errors="ignore")
+    else:
+        truncated = encoding.decode(
+            encoding.encode(text, disallowed_special=())[:max_tokens])
+    return truncated + "\n... [Truncated]"
+
+
+def collect_file_diffs(
+    pr: PullRequest,
+    git_dir: str,
+    head_sha: str | None = None,
+    max_file_bytes: int = MAX_FILE_DIFF_BYTES,
+    base_sha: str | None = None,
+    max_total_bytes: int = MAX_TOTAL_DIFF_BYTES
+) -> list[dict]:
+    """
+    PR의 파일별 diff 를 hunk 단위로 수집합니다.
+    base_sha 가 주어지면 PR의 base 대신 해당 커밋과 비교합니다.
+
+    먼저 'git diff --numstat' 으로 바이너리, lock 파일, 생성된 파일을 골라내고,
+    나머지 파일에 대해서만 전체 diff 를 스트리밍으로 요청합니다.
+    큰 파일은 건너뛰지 않고 max_file_bytes 까지의 hunk 만 남겨 pack_file_diffs 가 잘라 쓰도록 합니다.
+    전체 hunk 가 max_total_bytes 를 넘으면 그 뒤의 파일은 경로만 남깁니다.
+
+    Returns:
+        [{"path": "a.py", "hunks": ["L1+ : ..."], "note": None}]
+        note 는 diff 를 가져오지 않은 이유, 일부 hunk 가 잘린 경우 "Truncated",
+        전체 한도 때문에 hunk 를 읽지 않은 경우 "Omitted" 입니다.
+    """
+    diff_command = _prepare_git_diff(
+        pr, git_dir, 3, head_sha, GIT_FETCH_MODE, base_sha)
+
+    skipped = []
+    for entry in get_diff_numstat(diff_command, git_dir):
+        reason = classify_changed_file(entry)
+        if reason:
+            skipped.append((entry, reason))
+
+    if skipped:
+        diff_command = diff_command + ["--"] + [
+            f":(exclude,literal){path}"
+            for entry, _ in skipped
+            for path in entry["paths"]
+        ]
+
+    file_diffs = []
+    for path, patched_file, note in _iter_patched_files(
+            diff_command, git_dir, max_file_bytes, max_total_bytes):
+        file_diffs.append({
+            "path": path,
+            "hunks": [_format_hunk(hunk) for hunk in patched_file],
+            "note": note,
+        })
+    omitted = sum(1 for d in file_diffs if d["note"] == "Omitted")
+    if omitted:
+        print(f"[INFO] Omitted diff for {omitted} files over MAX_TOTAL_DIFF_BYTES({max_total_bytes})")
+    for entry, reason in skipped:
+        print(f"[INFO] Skipped diff for {entry['path']} ({reason})")
+        file_diffs.append({"path": entry["path"], "hunks": [], "note": reason})
+    return file_diffs
+
+
+def _file_relevance(path: str) -> float:
+    """
+    PR 본문 작성에 대한 파일의 중요도 가중치를 반환합니다.
+    소스 코드를 테스트, 문서, 설정 파일보다 우선합니다.
+    """
+    lower = path.lower()
+    name = os.path.basename(lower)
+    _, ext = os.path.splitext(name)
+    if ext in (".json", ".yml", ".yaml", ".toml", ".ini", ".cfg", ".xml", ".csv"):
+        return 0.3
+    if (
+        name.startswith("test_") or "_test." in name or ".test." in name
+        or ".spec." in name or "/tests/" in f"/{lower}" or "/__tests__/" in f"/{lower}"
+    ):
+        return 0.5
+    if ext in (".md", ".rst", ".txt"):
+        return 0.5
+    return 1.0
+
+
+def _allocate_tokens(costs: list[int], weights: list[float], budget: int) -> list[int]:
+    """
+    가중치에 비례하여 파일별 토큰 예산을 나눕니다.
+    할당량보다 작은 파일은 필요한 만큼만 가져가고, 남은 예산은 나머지 파일에 다시 나눕니다.
+    """
+    allocation = [0] * len(costs)
+    pending = [i for i, cost in enumerate(costs) if cost > 0]
+    remaining = max(budget, 0)
+    while pending:
+        total_weight = sum(weights[i] for i in pending)
+        shares = {i: remaining * weights[i] / total_weight for i in pending}
+        fits = [i for i in pending if costs[i] <= shares[i]]
+        if not fits:
+            for i in pending:
+                allocation[i] = int(shares[i])
+            break
+        for i in fits:
+            allocation[i] = costs[i]
+            remaining -= costs[i]
+            pending.remove(i)
+    return allocation
+
+
+def _truncate_hunk(hunk: str, max_tokens: int) -> str:
+    """
+    hunk 텍스트를 max_tokens 안에 들어가는 앞쪽 줄까지만 남깁니다.
+    생략 표시에 드는 토큰을 미리 빼고 계산합니다.
+    """
+    remaining = max_tokens - 8
+    kept = []
+    for line in hunk.split("\n"):
+        cost = count_tokens(line) + 1
+        if cost > remaining:
+            break
+        kept.append(line)
+        remaining -= cost
+    return "\n".join(kept)
+
+
+def pack_file_diffs(file_diffs: list[dict], token_budget: int) -> str:
+    """
+    파일별 diff 를 전체 토큰 예산 안에 들어가도록 묶습니다.
+
+    모든 파일의 경로는 항상 포함하고, 예산은 파일 중요도에 비례하여 나누며,
+    예산을 넘는 파일은 통째로 버리지 않고 앞쪽 hunk 부터 들어가는 만큼만 포함하며,
+    마지막 hunk 가 다 들어가지 않으면 앞쪽 줄만 잘라 넣습니다.
+
+    Args:
+        file_diffs (list[dict]): collect_file_diffs 의 결과
+        token_budget (int): diff 텍스트에 쓸 수 있는 최대 토큰 수
+
+    Returns:
+        LLM 에 전달할 diff 텍스트
+    """
+    # 파일 경로와 생략 표시에 드는 토큰을 먼저 확보합니다.
+    header_costs = [count_tokens(f"File: {d['path']}") + 8 for d in file_diffs]
+    listed = len(file_diffs)
+    while listed and sum(header_costs[:listed]) > token_budget:
+        listed -= 1
+    remaining = token_budget - sum(header_costs[:listed])
+
+    hunk_costs = [
+        [count_tokens(hunk) + 1 for hunk in d["hunks"]]
+        for d in file_diffs[:listed]
+    ]
+    allocation = _allocate_tokens(
+        [sum(costs) for costs in hunk_costs],
+        [_file_relevance(d["path"]) for d in file_diffs[:listed]],
+        remaining
+    )
+
+    patch_summary = []
+    for d, costs, allowed in zip(file_diffs, hunk_costs, allocation):
+        patch_summary.append(f"File: {d['path']}")
+        if not d["hunks"]:
+            if d["note"]:
+                patch_summary.append(f"Diff: [{d['note']}]")
+            continue
+
+        used, included = 0, 0
+        for cost in costs:
+            if used + cost > allowed:
+                break
+            used += cost
+            included += 1
+
+        # 들어가지 않는 첫 hunk 는 남은 예산만큼 앞쪽 줄을 넣습니다.
+        partial = ""
+        if included < len(d["hunks"]):
+            partial = _truncate_hunk(d["hunks"][included], allowed - used)
+
+        if included == 0 and not partial:
+            print(f"[WARN] Diff too large for {d['path']}")
+            patch_summary.append("Diff: [Too Long]")
+            continue
+        patch_summary += d["hunks"][:included]
+        if partial:
+            patch_summary += [partial, "... [rest of hunk omitted]"]
+        omitted = len(d["hunks"]) - included - (1 if partial else 0)
+        if partial or omitted:
+            print(f"[WARN] Diff trimmed for {d['path']}")
+        if omitted:
+            more = f"{omitted}+" if d["note"] else f"{omitted}"
+            patch_summary.append(f"... [{more} more hunks omitted]")
+        elif d["note"]:
+            patch_summary.append(f"... [{d['note']}]")
+
+    if listed < len(file_diffs):
+        patch_summary.append(f"... [{len(file_diffs) - listed} more files omitted]")
+    return "\n".join(patch_summary)
+
+
+def count_file_diffs_tokens(file_diffs: list[dict]) -> int:
+    """
+    파일별 diff 를 잘라내지 않고 모두 포함했을 때의 토큰 수를 계산합니다.
+    """
+    return sum(
+        count_tokens(f"File: {d['path']}") + 1 +
+        sum(count_tokens(hunk) + 1 for hunk in d["hunks"])
+        for d in file_diffs
+    )
+
+
+def group_file_diffs(file_diffs: list[dict], max_group_tokens: int) -> list[list[dict]]:
+    """
+    경로 순서를 유지하면서 파일별 diff 를 max_group_tokens 이하의 묶음으로 나눕니다.
+    git diff 는 경로 순으로 출력하므로 같은 디렉토리의 파일이 같은 묶음에 모입니다.
+    """
+    groups, current, current_tokens = [], [], 0
+    for d in file_diffs:
+        tokens = count_file_diffs_tokens([d])
+        if current and current_tokens + tokens > max_group_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(d)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def create_chat_completion(
+    client: OpenAI,
+    model_config: ModelConfig,
+    messages: list[dict],
+    on_delta: Callable[[str], None] | None = None,
+    cache_messages: list[dict] | None = None,
+    stream: bool = LLM_STREAM_ENABLED
+) -> str:
+    """
+    ChatCompletion 을 호출하고 응답 본문을 반환합니다.
+
+    API 주소, 모델 설정과 메시지 전체의 해시를 키로 응답을 CACHE_DIR 에 저장하므로,
+    워크플로가 다시 실행되어도 입력이 같으면 API 를 호출하지 않고 즉시 반환합니다.
+    cache_messages 가 주어지면 messages 대신 이것으로 키를 만듭니다.
+    LLM_CACHE=off 이면 캐시를 사용하지 않습니다.
+
+    on_delta 가 주어지거나 stream 이 True(기본값은 LLM_STREAM=on 여부)이면 응답을 스트리밍으로 받아
+    생성되는 대로 on_delta(없으면 표준 출력)에 전달합니다.
+    응답 전체가 LLM_TIMEOUT 초 안에 끝나지 않으면 TimeoutError 를 발생시킵니다.
+    """
+    model = model_config.model
+    key = hashlib.sha256(
+        json.dumps(
+            [str(client.base_url), model_config.request_options(), cache_messages or messages],
+            ensure_ascii=False
+        ).encode("utf-8")
+    ).hexdigest()
+    path = os.path.join(CACHE_DIR, "llm", f"{key}.json")
+
+    if LLM_CACHE_ENABLED:
+        try:
+            with open(path, encoding="utf-8") as f:
+                content = json.load(f)["content"]
+            print(f"LLM 응답을 캐시에서 불러왔습니다. ({model})")
+            if on_delta:
+                on_delta(content)
+            return content
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if on_delta or stream:
+        content = _stream_chat_completion(
+            client, model_config, messages, on_delta or _print_delta)
+    else:
+        response = call_with_retry(
+            "openai",
+            client.chat.completions.create,
+            **model_config.request_options(),
+            messages=messages,
+            timeout=LLM_TIMEOUT
+        )
+        content = response.choices[0].message.content
+        _log_usage(model, response.usage)
+
+    if LLM_CACHE_ENABLED and content:
+        try:
+            _write_json_atomic(path, {"model": model, "content": content})
+        except OSError as e:
+            print(f"[WARN] Failed to write LLM response cache: {e}")
+    return content
+
+
+def _log_usage(model: str, usage) -> None:
+    """
+    응답의 토큰 사용량과 프롬프트 캐시에서 읽은 입력 토큰 수를 출력합니다.
+    """
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    print(f"LLM 사용량 ({model}): 입력 {usage.prompt_tokens} 토큰 "
+          f"(캐시 {cached_tokens}), 출력 {usage.completion_tokens} 토큰")
+
+
+def _print_delta(delta: str):
+    print(delta, end="", flush=True)
+
+
+def _stream_chat_completion(
+    client: OpenAI,
+    model_config: ModelConfig,
+    messages: list[dict],
+    on_delta: Callable[[str], None]
+) -> str:
+    """
+    ChatCompletion 을 스트리밍으로 호출하며 받은 토큰을 on_delta 에 전달합니다.
+
+    청크 사이의 대기 시간은 요청 timeout 으로 제한하고, 응답 전체가 LLM_TIMEOUT 안에 끝나지 않으면
+    타이머가 스트림을 닫으므로 청크가 아주 느리게 계속 도착해도 작업이 무한정 대기하지 않습니다.
+    """
+    deadline = time.monotonic() + LLM_TIMEOUT
+    stream = call_with_retry(
+        "openai",
+        client.chat.completions.create,
+        **model_config.request_options(),
+        messages=messages,
+        stream=True,
+        # 마지막 청크로 토큰 사용량을 받습니다.
+        stream_options={"include_usage": True},
+        timeout=LLM_TIMEOUT
+    )
+    expired = threading.Event()
+
+    def close_on_deadline():
+        expired.set()
+        stream.close()
+
+    timer = threading.Timer(max(deadline - time.monotonic(), 0), close_on_deadline)
+    timer.daemon = True
+    timer.start()
+    parts = []
+    try:
+        for chunk in stream:
+            if expired.is_set():
+                break
+            if getattr(chunk, "usage", None):
+                _log_usage(model_config.model, chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+    except Exception:
+        # 타이머가 스트림을 닫아 읽기가 실패한 경우입니다.
+        if not expired.is_set():
+            raise
+    finally:
+        timer.cancel()
+        stream.close()
+    if expired.is_set():
+        raise TimeoutError(
+            f"LLM response did not finish within {LLM_TIMEOUT} seconds.")
+    return "".join(parts)
+
+
+def summarize_file_group(client: OpenAI, group: list[dict]) -> str:
+    """
+    파일 묶음의 diff 를 SUMMARY_MODEL 로 요약합니다.
+    """
+    patch_text = pack_file_diffs(group, SUMMARY_GROUP_TOKENS)
+    return create_chat_completion(
+        client,
+        SUMMARY_MODEL_CONFIG,
+        [
+            {
+                "role": "system",
+                "content": (
+                    "You are a great software engineer. "
+                    "Summarize the given code changes concisely for a PR description. "
+                    "Describe what changed and why it matters, file by file. "
+                    "Answer in English bullet points.\n\n"
+                    f"{PATCH_FORMAT_LEGEND}"
+                )
+            },
+            {
+                "role": "user",
+                "content": f"# Patch Diff:\n{patch_text}"
+            },
+        ],
+        # 중간 요약은 사람이 읽을 출력이 아니므로 스트리밍하지 않습니다.
+        stream=False
+    )
+
+
+def summarize_file_diffs(
+    client: OpenAI,
+    file_diffs: list[dict],
+    workers: int = SUMMARY_WORKERS
+) -> str:
+    """
+    diff 를 파일 묶음으로 나누어 병렬로 요약(map)하고, 묶음 순서대로 이어 붙입니다.
+    최종 PR 본문 작성(reduce)은 build_pr_messages 가 이 요약을 프롬프트에 넣어 수행합니다.
+
+    Returns:
+        묶음별 요약을 이어 붙인 텍스트
+    """
+    groups = group_file_diffs(file_diffs, SUMMARY_GROUP_TOKENS)
+    print(f"Diff 가 너무 커서 {len(groups)}개 묶음으로 나누어 요약합니다.")
+    with ThreadPoolExecutor(max_workers=workers, initializer=inherit_output_buffer()) as executor:
+        summaries = list(executor.map(
+            lambda group: summarize_file_group(client, group), groups))
+
+    sections = []
+    for group, summary in zip(groups, summaries):
+        paths = ", ".join(d["path"] for d in group)
+        sections.append(f"## Files: {paths}\n{summary}")
+    return "\n\n".join(sections)
+
+
+def build_system_prompt(system_prompt: str, pr: PullRequest) -> str:
+    """
+    LLM 에 전달할 시스템 프롬프트를 만듭니다.
+
+    공급자의 프롬프트 캐시는 요청 앞부분이 이전 요청과 같을 때만 적용되므로,
+    고정 지시문, diff 형식 설명, 레포지토리 정보처럼 같은 레포지토리의 모든 PR에서
+    변하지 않는 내용만 시스템 프롬프트에 넣고, PR마다 달라지는 내용은 사용자 프롬프트에 둡니다.
+    """
+    repo = pr.base.repo
+    repo_context = f"# Repository:\n{repo.full_name}\n"
+    if repo.description:
+        repo_context += f"{repo.description}\n"
+    return "".join([
+        "You are a great software engineer. "
+        "Return only the PR body text.\n\n",
+        PATCH_FORMAT_LEGEND,
+        "\n",
+        repo_context,
+        f"\n{system_prompt}" if system_prompt else "",
+    ])
+
+
+def build_pr_prompt(
+    patch_text: str,
+    notion_md: str | None,
+    pr: PullRequest,
+    change_summary: str | None = None,
+    include_body: bool = True
+) -> str:
+    """
+    LLM 에 전달할 사용자 프롬프트를 만듭니다.
+    change_summary 가 주어지면 diff 앞에 파일 묶음별 변경 요약을 넣습니다.
+    include_body 가 False 이면 PR 본문을 넣지 않습니다. (캐시 키 계산용)
+
+    같은 PR을 다시 실행할 때 캐시되는 앞부분이 길어지도록,
+    잘 바뀌지 않는 제목과 노션 문서를 먼저 두고 본문(이 도구가 덮어씀)과 diff 를 뒤에 둡니다.
+    """
+    prompt_lines = [
+        f"# PR Title:\n{pr.title}\n\n",
+        "----\n\n",
+    ]
+    if notion_md:
+        prompt_lines.append(f"# Notion Document:\n{notion_md}\n\n")
+        prompt_lines.append("----\n\n")
+    if include_body:
+        prompt_lines += [
+            f"# PR Body:\n{truncate_to_tokens(pr.body or '', MAX_PR_BODY_TOKENS)}\n\n",
+            "----\n\n",
+        ]
+    if change_summary:
+        prompt_lines += [
+            "# Change Summary:\n"
+            "_The full diff was too large. These summaries cover every changed file; "
+            "the diff below is trimmed._\n"
+            f"{change_summary}\n\n",
+            "----\n\n",
+        ]
+    prompt_lines += [
+        f"# Patch Diff:\n{patch_text}\n\n",
+        "----\n\n",
+        "Please write down a nice PR body from this PR."
+    ]
+    return "".join(prompt_lines)
+
+
+def get_patch_token_budget(
+    notion_md: str | None,
+    pr: PullRequest,
+    system_prompt: str,
+    change_summary: str | None = None
+) -> int:
+    """
+    시스템 프롬프트, 노션 문서, PR 제목/본문, 변경 요약을 제외하고 diff 에 쓸 수 있는 토큰 수를 계산합니다.
+    나머지가 이미 예산을 넘으면 0 을 반환합니다.
+    """
+    fixed_tokens = count_tokens(build_system_prompt(system_prompt, pr)) + \
+        count_tokens(build_pr_prompt("", notion_md, pr, change_summary))
+    return max(MAX_PROMPT_TOKENS - fixed_tokens, 0)
+
+
+def choose_model(
+    diff_tokens: int,
+    file_count: int,
+    notion_md: str | None = None,
+    change_summary: str | None = None
+) -> ModelConfig:
+    """
+    PR 크기에 맞는 모델을 고릅니다.
+    diff 와 파일 수가 작고 노션 문서도 짧으면 SMALL_PR_MODEL, 그 외에는 PR_MODEL 을 사용합니다.
+    LLM_ROUTING=on 일 때만 동작하며, 꺼져 있으면 항상 PR_MODEL 을 반환합니다.
+    """
+    if not LLM_ROUTING_ENABLED or change_summary:
+        return PR_MODEL
+    if diff_tokens > ROUTING_SMALL_DIFF_TOKENS or file_count > ROUTING_SMALL_FILES:
+        return PR_MODEL
+    if notion_md and count_tokens(notion_md) > ROUTING_SMALL_NOTION_TOKENS:
+        return PR_MODEL
+    return SMALL_PR_MODEL
+
+
+def complete_with_escalation(
+    model_config: ModelConfig,
+    generate: Callable[[ModelConfig], str],
+    on_escalate: Callable[[], None] | None = None
+) -> str:
+    """
+    model_config 로 본문을 생성하고, 작은 모델이 실패하거나 빈 응답을 주면 PR_MODEL 로 다시 생성합니다.
+    on_escalate 는 PR_MODEL 로 다시 생성하기 직전에 호출됩니다.
+    """
+    if model_config == PR_MODEL:
+        return generate(PR_MODEL)
+
+    print(f"작은 PR이므로 {model_config.model} 모델로 본문을 생성합니다.")
+    try:
+        content = generate(model_config)
+        if content and content.strip():
+            return content
+        print(f"[WARN] {model_config.model} returned an empty body, escalating to {PR_MODEL.model}.")
+    except (APIError, TimeoutError) as e:
+        print(f"[WARN] {model_config.model} failed, escalating to {PR_MODEL.model}: {e}")
+    if on_escalate:
+        on_escalate()
+    return generate(PR_MODEL)
+
+
+def build_pr_messages(
+    patch_text: str,
+    notion_md: str | None,
+    pr: PullRequest,
+    system_prompt: str,
+    change_summary: str | None = None
+) -> list[dict]:
+    """
+    PR 본문 작성을 위한 ChatCompletion 메시지를 만듭니다.
+    """
+    prompt = build_pr_prompt(patch_text, notion_md, pr, change_summary)
+    system_content = build_system_prompt(system_prompt, pr)
+    prompt_tokens = count_tokens(system_content) + count_tokens(prompt)
+    if prompt_tokens > MAX_PROMPT_TOKENS:
+        print(f"[WARN] Prompt has {prompt_tokens} tokens, over MAX_PROMPT_TOKENS({MAX_PROMPT_TOKENS}).")
+    return [
+        {
+            "role": "system",
+            "content": system_content
+        },
+        {
+            "role": "user",
+            "content": prompt
+        },
+    ]
+
+
+def add_head_marker(body: str, head_sha: str) -> str:
+    """
+    PR 본문 끝에 본문을 생성한 head 커밋을 숨김 주석으로 기록합니다.
+    """
+    return f"{body.rstrip()}\n\n<!-- ai-pr-writer head={head_sha} -->"
+
+
+def parse_head_marker(body: str | None) -> tuple[str, str] | None:
+    """
+    add_head_marker 로 기록한 head 커밋을 PR 본문에서 찾습니다.
+
+    Returns:
+        (head 커밋 SHA, 주석을 제거한 본문) 또는 None
+    """
+    match = HEAD_MARKER_PATTERN.search(body or "")
+    if not match:
+        return None
+    return match.group(1), body[:match.start()].rstrip()
+
+
+def is_generated_body(pr: PullRequest) -> bool:
+    """
+    PR 본문이 이 도구가 작성한 것인지(head 표시나 LABEL 라벨이 있는지) 확인합니다.
+    """
+    if parse_head_marker(pr.body):
+        return True
+    return any(label.name == LABEL_NAME for label in pr.labels)
+
+
+def is_incremental_update(pr: PullRequest, old_sha: str, new_sha: str) -> bool:
+    """
+    old_sha..new_sha 의 diff 를 PR 의 새 작업으로 볼 수 있는지 GitHub API 로 확인합니다.
+    shallow checkout 에서도 동작하도록 로컬 히스토리 대신 compare API 를 사용합니다.
+
+    다음 경우에는 diff 에 PR 과 무관한 변경이 섞이므로 False 를 반환합니다.
+    - force push 등으로 new_sha 가 old_sha 에 커밋을 추가한 것이 아닌 경우
+    - 새 커밋 중 merge 커밋이 있는 경우 (base 브랜치를 PR 브랜치로 merge 한 경우)
+    - PR 의 base 커밋이 old_sha 의 조상이 아닌 경우 (rebase 또는 base 브랜치 변경)
+    """
+    repo = pr.base.repo
+    try:
+        comparison = repo.compare(old_sha, new_sha)
+        if comparison.status != "ahead":
+            return False
+        if any(len(commit.parents) > 1 for commit in comparison.commits):
+            print("새 커밋에 merge 커밋이 있어 PR 본문을 처음부터 다시 작성합니다.")
+            return False
+        if repo.compare(pr.base.sha, old_sha).status not in ("ahead", "identical"):
+            print("PR 의 base 가 바뀌어 PR 본문을 처음부터 다시 작성합니다.")
+            return False
+    except GithubException as e:
+        print(f"[WARN] Failed to compare {old_sha}...{new_sha}: {e}")
+        return False
+    return True
+
+
+def build_update_prompt(patch_text: str, previous_body: str, pr: PullRequest) -> str:
+    """
+    이전에 작성한 PR 본문을 새 커밋의 변경 사항에 맞춰 고치기 위한 프롬프트를 만듭니다.
+    """
+    return "".join([
+        f"# PR Title:\n{pr.title}\n\n",
+        "----\n\n",
+        f"# Current PR Body:\n{truncate_to_tokens(previous_body, MAX_PR_BODY_TOKENS)}\n\n",
+        "----\n\n",
+        f"# New Patch Diff (since the current PR body was written):\n{patch_text}\n\n",
+        "----\n\n",
+        "Please update the current PR body so that it also reflects the new changes. "
+        "Keep the parts that are still accurate as they are."
+    ])
+
+
+@dataclass
+class PrBodyRequest:
+    """
+    LLM 호출 직전까지 준비된 PR 본문 생성 요청입니다.
+    """
+    model_config: ModelConfig
+    messages: list[dict]
+    # 본문을 생성하는 기준 head 커밋 (INCREMENTAL 표시용)
+    head_sha: str
+    # LLM 응답 캐시 키에 쓸 메시지 (None 이면 messages)
+    cache_messages: list[dict] | None = None
+
+
+def prepare_incremental_request(
+    pr: PullRequest,
+    system_prompt: str,
+    git_dir: str,
+    previous_sha: str,
+    previous_body: str,
+    head_sha: str
+) -> PrBodyRequest:
+    """
+    이전 본문을 생성한 커밋 이후의 diff 와 이전 본문만으로 PR 본문 갱신 요청을 만듭니다.
+    이전 본문에 노션 문서 내용이 이미 반영되어 있으므로 노션 조회는 생략합니다.
+    """
+    print(f"{previous_sha} 이후의 변경 사항만으로 PR 본문을 갱신합니다.")
+    file_diffs = collect_file_diffs(
+        pr, git_dir, head_sha=head_sha, base_sha=previous_sha)
+
+    system_content = build_system_prompt(system_prompt, pr)
+    fixed_tokens = count_tokens(system_content) + \
+        count_tokens(build_update_prompt("", previous_body, pr))
+    patch_text = pack_file_diffs(file_diffs, max(MAX_PROMPT_TOKENS - fixed_tokens, 0))
+    print(patch_text)
+
+    return PrBodyRequest(
+        model_config=choose_model(
+            count_file_diffs_tokens(file_diffs), len(file_diffs)),
+        messages=[
+            {
+                "role": "system",
+                "content": system_content
+            },
+            {
+                "role": "user",
+                "content": build_update_prompt(patch_text, previous_body, pr)
+            },
+        ],
+        head_sha=head_sha,
+    )
 
 
-def search_page(notion: NotionClient, data_source_id: str, property_name: str, number: int) -> dict | None:
+def get_notion_markdown(title: str, clients: Clients) -> str | None:
     """
-    노션 페이지를 검색해옵니다.
+    PR 제목의 Task ID에 해당하는 노션 페이지를 찾아 마크다운으로 변환합니다.
+    캐시된 데이터 소스가 404(object_not_found)를 반환하면 접두사 캐시를 지우고 한 번만 다시 검색합니다.
 
     Args:
-        notion (NotionClient)
-        data_source_id (str): 노션 데이터 소스 ID
-        property_name (str): Task ID를 저장하는 속성 이름
-        number (int): 노션 페이지의 Task ID
+        title (str): PR 제목
+        clients (Clients)
 
     Returns:
-        노션 페이지의 정보 또는 None
+        노션 페이지의 마크다운 또는 None
     """
-    # API version 2025-09-03: databases.query is now data_sources.query
-    # Using request method directly for compatibility with notion-client library
-    response = notion.request(
-        path=f"data_sources/{data_source_id}/query",
-        method="POST",
-        body={
-            "filter": {
-                "property": property_name,
-                "unique_id": {
-                    "equals": number
-                }
-            }
-        }
-    )
+    notion = clients.notion
+    notion_token = clients.notion_token
+    # 접두사 매핑이 설정되어 있으면 데이터 소스를 검색하지 않고 바로 조회합니다.
+    found = lookup_task_id(title, load_static_prefix_index())
+    from_mapping = found is not None
+    if not found:
+        found = find_notion_task(notion, notion_token, title)
+    if not found and TASK_ID_CANDIDATE_PATTERN.search(title) and \
+            can_refresh_prefixes(notion_token):
+        # 캐시 이후 새 데이터베이스가 추가되었을 수 있으므로 한 번 더 검색합니다.
+        found = find_notion_task(notion, notion_token, title, refresh=True)
+    if not found:
+        print("PR 제목에서 유효한 Task ID를 찾지 못했습니다.")
+        return None
 
-    results = response.get("results", [])
-    if not results:
+    task_id, item = found
+    number = int(task_id.rsplit("-", 1)[1])
+    try:
+        notion_page = search_page(
+            notion, item["data_source_id"], item["property_name"], number)
+    except APIResponseError as e:
+        if from_mapping or e.code != APIErrorCode.ObjectNotFound:
+            raise
+        # 캐시된 데이터 소스가 삭제되었거나 공유가 해제되었으므로 캐시를 버리고 한 번만 다시 찾습니다.
+        print(f"[WARN] Cached Notion data source not found, searching prefixes again: {e}")
+        invalidate_cached_prefixes(notion_token)
+        found = find_notion_task(notion, notion_token, title, refresh=True)
+        if not found:
+            print("PR 제목에서 유효한 Task ID를 찾지 못했습니다.")
+            return None
+        task_id, item = found
+        number = int(task_id.rsplit("-", 1)[1])
+        notion_page = search_page(
+            notion, item["data_source_id"], item["property_name"], number)
+    if not notion_page:
+        print(f"Task ID {task_id}에 해당하는 Notion 페이지를 찾을 수 없습니다.")
         return None
-    return results[0]  # 첫 번째 매칭된 페이지 반환
 
+    print(f"Notion 페이지 ID: {notion_page['id']} 조회됨.")
+    # 페이지가 마지막 실행 이후 수정되지 않았으면 블록을 다시 조회하지 않습니다.
+    notion_md = load_cached_page_markdown(notion_page)
+    if notion_md is not None:
+        print("Notion 페이지를 캐시에서 불러왔습니다.")
+        return notion_md
+    notion_md = export_notion_page(notion, notion_page)
+    save_cached_page_markdown(notion_page, notion_md)
+    return notion_md
 
-def get_patchset_from_git(
+
+def prepare_pr_body_request(
     pr: PullRequest,
+    clients: Clients,
+    system_prompt: str,
     git_dir: str,
-    context_lines: int = 3
-) -> PatchSet:
+    head_sha: str | None = None
+) -> PrBodyRequest | None:
     """
-    'git diff --unified={context_lines} {base_ref}' 명령어를 실행해
-    unified diff를 얻은 뒤, unidiff 라이브러리로 PatchSet 객체를 만들어 반환한다.
+    노션 문서와 diff 를 모아 LLM 호출 직전까지의 PR 본문 생성 요청을 만듭니다.
+    head_sha 가 주어지면 체크아웃 없이 객체 ID만으로 diff 를 계산합니다.
 
-    Args:
-        pr (PullRequest): The pull request object.
-        context_lines (int): diff 생성 시 포함할 context 줄 수(기본 3줄)
+    노션 조회와 git diff 추출은 서로 독립적이므로 동시에 실행하여,
+    PR당 소요 시간이 두 단계의 합이 아니라 더 긴 쪽에 가까워지도록 합니다.
 
     Returns:
-        PatchSet: unidiff로 파싱된 diff 정보를 담은 PatchSet 객체
+        PrBodyRequest 또는 INCREMENTAL 모드에서 새 커밋이 없으면 None
     """
-    # GHA에서는 1001 사용자로 checkout 해주지만
-    # Docker 사용자는 root 로 하길 권장합니다.
-    # 따라서 safe.directory 설정이 필요합니다.
-    # 그렇지 않으면 get diff 에서 not a git repository 에러가 발생합니다.
-    result = subprocess.run(
-        ['git', 'config', '--global', '--add', 'safe.directory', git_dir],
-        capture_output=True,
-        text=True,
-        check=False
-    )
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"Failed to run git config. Return code: {result.returncode}\n"
-            f"stderr: {result.stderr}"
-        )
+    current_head = head_sha or pr.head.sha
+    if INCREMENTAL_ENABLED:
+        previous = parse_head_marker(pr.body)
+        if previous and previous[0] == current_head:
+            print("이전에 본문을 생성한 이후 새 커밋이 없습니다.")
+            return None
+        if previous and is_incremental_update(pr, previous[0], current_head):
+            return prepare_incremental_request(
+                pr, system_prompt, git_dir,
+                previous[0], previous[1], current_head)
+
+    with ThreadPoolExecutor(max_workers=1, initializer=inherit_output_buffer()) as executor:
+        # 1) 노션 페이지 내용 가져오기 (백그라운드)
+        notion_future = executor.submit(get_notion_markdown, pr.title, clients)
+
+        # 2) git diff 추출
+        file_diffs = collect_file_diffs(pr, git_dir, head_sha)
+
+        notion_md = notion_future.result()
+
+    # 노션 문서는 전체 예산의 절반까지만 사용하고, 나머지를 diff 에 배정합니다.
+    if notion_md:
+        notion_md = truncate_to_tokens(notion_md, MAX_PROMPT_TOKENS // 2)
+    patch_budget = get_patch_token_budget(notion_md, pr, system_prompt)
+
+    # diff 가 예산을 넘으면 파일 묶음별 요약을 먼저 만들고, 남은 예산만큼 diff 를 잘라 넣습니다.
+    change_summary = None
+    diff_tokens = count_file_diffs_tokens(file_diffs)
+    if MAP_REDUCE_MODE == "auto" and diff_tokens > patch_budget:
+        change_summary = summarize_file_diffs(clients.openai, file_diffs)
+        change_summary = truncate_to_tokens(change_summary, patch_budget // 2)
+        patch_budget = get_patch_token_budget(
+            notion_md, pr, system_prompt, change_summary)
+    patch_text = pack_file_diffs(file_diffs, patch_budget)
+    print(patch_text)
 
-    print(f"pr.base.sha: {pr.base.sha}")
-    result = subprocess.run(
-        [
-            'git',
-            'fetch',
-            'origin',
-            pr.base.sha,
-        ],
-        capture_output=True,
-        text=True,
-        check=False,
-        cwd=git_dir
-    )
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"Failed to run git fetch. Return code: {result.returncode}\n"
-            f"stderr: {result.stderr}"
-        )
+    messages = build_pr_messages(
+        patch_text, notion_md, pr, system_prompt, change_summary)
+    cache_messages = None
+    if is_generated_body(pr):
+        # 이전 실행이 쓴 본문은 실행마다 바뀌므로, 캐시 키에서 빼야 같은 입력의 재실행이 캐시를 씁니다.
+        cache_messages = [
+            messages[0],
+            {
+                "role": "user",
+                "content": build_pr_prompt(
+                    patch_text, notion_md, pr, change_summary, include_body=False)
+            },
+        ]
 
-    result = subprocess.run(
-        [
-            "git",
-            "--no-pager",
-            "diff",
-            f"--unified={context_lines}",
-            pr.base.sha,
-        ],
-        capture_output=True,
-        text=True,
-        check=False,
-        cwd=git_dir
+    return PrBodyRequest(
+        # 작은 PR은 작은 모델부터 시도
+        model_config=choose_model(
+            diff_tokens, len(file_diffs), notion_md, change_summary),
+        messages=messages,
+        head_sha=current_head,
+        cache_messages=cache_messages,
     )
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"Failed to run git diff. Return code: {result.returncode}\n"
-            f"stderr: {result.stderr}"
-        )
 
-    diff_text = result.stdout
-    return PatchSet(diff_text)
 
-
-def get_patch_text_from_patchset(
-    patch_set: PatchSet,
-    max_diff_bytes: int = 10 * 1024  # 기본 10KB 제한, 필요에 따라 조정 가능
-) -> str:
-    patch_summary = []
-    for patched_file in patch_set:
-        patch_summary.append(f"File: {patched_file.path}")
-        file_diff_lines = []
-        # 각 파일의 모든 hunk의 라인 정보를 모아서 하나의 문자열로 생성
-        for hunk in patched_file:
-            for line in hunk:
-                if line.is_added:
-                    file_diff_lines.append(
-                        f"L{line.target_line_no}+ : {line.value.rstrip()}"
-                    )
-                elif line.is_removed:
-                    file_diff_lines.append(
-                        f"L{line.source_line_no}- : {line.value.rstrip()}"
-                    )
-                else:
-                    file_diff_lines.append(
-                        f"L{line.source_line_no} : {line.value.rstrip()}"
-                    )
-        file_diff_text = "\n".join(file_diff_lines)
-        # utf-8 인코딩 바이트 수 기준으로 크기 체크
-        if len(file_diff_text.encode("utf-8")) > max_diff_bytes:
-            print(f"[WARN] Diff too large for {patched_file.path}")
-            patch_summary.append("Diff: [Too Long]")
-        else:
-            patch_summary.append(file_diff_text)
-    return "\n".join(patch_summary)
+def finalize_pr_body(request: PrBodyRequest, ai_pr_body: str) -> str:
+    """
+    생성된 본문에 INCREMENTAL 모드용 head 표시를 붙입니다.
+    """
+    if INCREMENTAL_ENABLED:
+        return add_head_marker(ai_pr_body, request.head_sha)
+    return ai_pr_body
 
 
-def get_chatgpt_pr_body(
-    patch_text: str,
-    notion_md: str | None,
+def generate_pr_body(
     pr: PullRequest,
+    clients: Clients,
     system_prompt: str,
-) -> str:
+    git_dir: str,
+    head_sha: str | None = None,
+    on_delta: Callable[[str], None] | None = None
+) -> str | None:
     """
-    Send patch_text + notion_md to ChatGPT(O1) (via openai) and return pr body.
+    PR 본문 생성을 위한 전체 프로세스를 실행합니다.
 
-    Args:
-        patch_text (str): The unified diff text of the PR.
-        notion_md (str): The markdown content of the Notion page.
+    INCREMENTAL=on 이면 생성한 본문에 head 커밋을 기록해 두고,
+    다음 실행에서 그 커밋 이후의 diff 만으로 본문을 갱신합니다.
 
     Returns:
-        str: The generated PR body.
+        새 PR 본문 또는 INCREMENTAL 모드에서 새 커밋이 없어 갱신할 필요가 없으면 None
     """
-    client = OpenAI()
+    # 1), 2) 노션 문서와 diff 로 요청 준비
+    request = prepare_pr_body_request(pr, clients, system_prompt, git_dir, head_sha)
+    if request is None:
+        return None
 
-    # 1) 프롬프트 생성
-    prompt_lines = []
-    if notion_md:
-        prompt_lines.append(f"# Notion Document:\n{notion_md}")
-        prompt_lines.append("----\n\n")
-    prompt_lines += [
-        f"# PR Title:\n{pr.title}\n\n",
-        "----\n\n",
-        f"# PR Body:\n{pr.body}\n\n",
-        "----\n\n",
-        f"# Patch Diff:\n"
-        "_L13+ : This line was added in the PR._\n"
-        "_L13- : This line was removed in the PR._\n"
-        "_L13 : This line was unchanged in the PR._\n"
-        f"{patch_text}\n\n"
-        "----\n\n",
-        "Please write down a nice PR body from this PR."
-    ]
-    prompt = "".join(prompt_lines)
+    def on_escalate():
+        # 작은 모델의 출력이 이미 스트리밍되었으므로 구분 표시 뒤에 새 본문을 처음부터 보여줍니다.
+        header = f"\n\n====== {PR_MODEL.model} 모델로 다시 생성한 새 PR 본문 ======\n"
+        if on_delta:
+            on_delta(header)
+        elif LLM_STREAM_ENABLED:
+            print(header, flush=True)
 
-    # 2) ChatCompletion 호출
-    response = client.chat.completions.create(
-        model="o1",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a great software engineer. "
-                    "Return only the PR body text. " + system_prompt
-                )
-            },
-            {
-                "role": "user",
-                "content": prompt
-            },
-        ]
+    # 3) AI로 PR 본문 생성
+    ai_pr_body = complete_with_escalation(
+        request.model_config,
+        lambda config: create_chat_completion(
+            clients.openai, config, request.messages, on_delta,
+            request.cache_messages),
+        on_escalate
     )
-    return response.choices[0].message.content
+    return finalize_pr_body(request, ai_pr_body)
 
 
-def generate_pr_body(pr: PullRequest, notion_token: str, system_prompt: str, git_dir: str) -> str:
+def run_openai_batch(client: OpenAI, requests: dict[str, PrBodyRequest]) -> dict[str, str]:
     """
-    PR 본문 생성을 위한 전체 프로세스를 실행합니다.
+    여러 PR 본문 생성 요청을 OpenAI Batch API 작업 하나로 제출하고 결과를 기다립니다.
+    Batch API 는 응답이 최대 24시간까지 늦을 수 있는 대신 비용이 낮으므로,
+    사람이 기다리지 않는 과거 PR 일괄 작성에 사용합니다.
+
+    Batch 작업에는 모델 승격을 적용할 수 없으므로 요청마다 정해진 모델만 사용합니다.
+
+    Args:
+        client (OpenAI): OpenAI 클라이언트
+        requests (dict[str, PrBodyRequest]): custom_id 별 요청
+
+    Returns:
+        dict[str, str]: 성공한 요청의 custom_id 별 응답 본문
     """
-    # 1) 노션 페이지 내용 가져오기
-    # API version 2025-09-03을 사용하여 data_source 지원
-    notion = NotionClient(auth=notion_token, notion_version="2025-09-03")
-    db_prefixes = extract_notion_db_name_prefixes(notion)
-    task_id = extract_dynamic_task_id(
-        pr.title, [p["prefix"] for p in db_prefixes])
-    notion_md = None
-    if task_id:
-        prefix, num_str = task_id.split("-")
-        number = int(num_str)
-        for item in db_prefixes:
-            if item["prefix"].lower() == prefix.lower():
-                data_source_id = item["data_source_id"]
-                property_name = item["property_name"]
-                notion_page = search_page(
-                    notion, data_source_id, property_name, number)
-                if notion_page:
-                    print(f"Notion 페이지 ID: {notion_page['id']} 조회됨.")
-                    notion_md = StringExporter(
-                        block_id=notion_page["id"]).export()
-                else:
-                    print(f"Task ID {task_id}에 해당하는 Notion 페이지를 찾을 수 없습니다.")
-                break
-    else:
-        print("PR 제목에서 유효한 Task ID를 찾지 못했습니다.")
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                **request.model_config.request_options(),
+                "messages": request.messages,
+            },
+        }, ensure_ascii=False)
+        for custom_id, request in requests.items()
+    ]
+    # 파일 업로드와 작업 생성은 중복 제출(중복 과금)을 막기 위해 429 외에는 재시도하지 않습니다.
+    input_file = call_with_retry(
+        "openai",
+        client.files.create,
+        idempotent=False,
+        file=("requests.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = call_with_retry(
+        "openai",
+        client.batches.create,
+        idempotent=False,
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Batch 작업 {batch.id} 에 {len(lines)}개의 요청을 제출했습니다.")
 
-    # 2) git diff 추출
-    patch_set = get_patchset_from_git(pr, git_dir)
-    patch_text = get_patch_text_from_patchset(patch_set)
-    print(patch_text)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(OPENAI_BATCH_POLL_SECONDS)
+        batch = call_with_retry("openai", client.batches.retrieve, batch.id)
+        print(f"Batch 작업 {batch.id} 상태: {batch.status}")
 
-    # 3) AI로 PR 본문 생성
-    ai_pr_body = get_chatgpt_pr_body(patch_text, notion_md, pr, system_prompt)
-    return ai_pr_body
+    if batch.status != "completed":
+        print(f"[WARN] Batch 작업 {batch.id} 이(가) {batch.status} 상태로 끝났습니다.")
+
+    results = {}
+    # 만료되거나 취소된 작업도 끝난 요청의 결과는 output 파일에 남습니다.
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = call_with_retry("openai", client.files.content, file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            custom_id = record["custom_id"]
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                print(f"[ERROR] {custom_id} 요청이 실패했습니다: "
+                      f"{record.get('error') or response.get('body')}")
+                continue
+            results[custom_id] = response["body"]["choices"][0]["message"]["content"]
+    return results
 
 
 def confirm_overwrite(existing_body: str, new_body: str) -> bool:
@@ -357,13 +2477,63 @@ def confirm_overwrite(existing_body: str, new_body: str) -> bool:
     print(existing_body)
     print("\n====== AI로 생성된 새 PR 본문 ======")
     print(new_body)
+    return ask_overwrite()
+
+
+def ask_overwrite() -> bool:
+    """
+    덮어쓸지 사용자에게 확인합니다.
+    """
     choice = input("\n이 PR 본문으로 덮어쓰시겠습니까? (y/n): ").strip().lower()
     return choice == "y"
 
 
+def make_streaming_preview(existing_body: str) -> Callable[[str], None]:
+    """
+    생성 중인 PR 본문을 기존 본문과 함께 바로 보여주는 on_delta 콜백을 만듭니다.
+    첫 토큰이 도착하면 기존 본문을 출력하고, 이후 새 본문을 생성되는 대로 이어서 출력합니다.
+    """
+    started = False
+
+    def on_delta(delta: str):
+        nonlocal started
+        if not started:
+            started = True
+            print("\n====== 기존 PR 본문 ======")
+            print(existing_body)
+            print("\n====== AI로 생성된 새 PR 본문 ======")
+        print(delta, end="", flush=True)
+
+    return on_delta
+
+
+def apply_pr_body(pr: PullRequest, ai_body: str, label_name: str):
+    """
+    PR 본문을 덮어쓰고 라벨을 추가합니다.
+    PyGithub 은 PATCH 요청을 재시도하지 않으므로 본문 수정만 call_with_retry 로 보내고,
+    라벨 조회와 생성(GET, POST)은 PyGithub 의 기본 재시도를 사용합니다.
+    """
+    call_with_retry("github", pr.edit, body=ai_body)
+    repo = pr.base.repo
+    try:
+        label = repo.get_label(label_name)
+    except UnknownObjectException:
+        try:
+            label = repo.create_label(
+                name=label_name, color="f29513", description="PR body auto-generated by AI."
+            )
+        except GithubException as e:
+            # 다른 작업이 먼저 만들었거나, 재시도 전에 이미 만들어진 경우 (422 already_exists)
+            if e.status != 422:
+                raise
+            label = repo.get_label(label_name)
+    pr.add_to_labels(label)
+    print(f"PR #{pr.number} 본문이 업데이트되었습니다.")
+
+
 def process_single_pr(
     pr: PullRequest,
-    notion_token: str,
+    clients: Clients,
     system_prompt: str,
     label_name: str,
     git_dir: str,
@@ -373,18 +2543,12 @@ def process_single_pr(
     하나의 PR에 대해 AI 본문 생성 및 덮어쓰기 작업을 수행합니다.
     """
     print(f"\nProcessing PR #{pr.number}: {pr.title}")
-    ai_body = generate_pr_body(pr, notion_token, system_prompt, git_dir)
+    ai_body = generate_pr_body(pr, clients, system_prompt, git_dir)
+    if ai_body is None:
+        print(f"PR #{pr.number} 본문을 갱신할 필요가 없습니다.")
+        return
     if not need_confirm or confirm_overwrite(pr.body, ai_body):
-        pr.edit(body=ai_body)
-        repo = pr.base.repo
-        try:
-            label = repo.get_label(label_name)
-        except UnknownObjectException:
-            label = repo.create_label(
-                name=label_name, color="f29513", description="PR body auto-generated by AI."
-            )
-        pr.add_to_labels(label)
-        print(f"PR #{pr.number} 본문이 업데이트되었습니다.")
+        apply_pr_body(pr, ai_body, label_name)
     else:
         print(f"PR #{pr.number} 본문 업데이트가 취소되었습니다.")
 
@@ -401,41 +2565,25 @@ def process_single_pr_from_env():
     pr_number_str = os.getenv("PR_NUMBER")
     notion_token = os.getenv("NOTION_TOKEN")
     system_prompt = os.getenv("SYSTEM_PROMPT") or ""
-    label_name = os.getenv("LABEL") or "ai-pr-written"
+    label_name = LABEL_NAME
 
     if not github_token or not repo_name or not pr_number_str or not notion_token:
         raise EnvironmentError(
             "GITHUB_TOKEN, GITHUB_REPOSITORY, PR_NUMBER, NOTION_TOKEN 환경 변수가 필요합니다.")
 
     pr_number = int(pr_number_str)
-    auth = Auth.Token(github_token)
-    g = Github(auth=auth)
-    repo = g.get_repo(repo_name)
+    clients = create_clients(github_token, notion_token)
+    repo = clients.github.get_repo(repo_name)
     pr = repo.get_pull(pr_number)
     # non-batch 모드에서는 기존 경로 사용
     git_dir = "/github/workspace"
-    process_single_pr(pr, notion_token, system_prompt, label_name, git_dir)
+    process_single_pr(pr, clients, system_prompt, label_name, git_dir)
 
 
-def process_all_prs():
+def iter_target_prs(repo, label_name: str) -> Iterator[PullRequest]:
     """
-    특정 레포지토리의 모든 열려있는 PR 중
-    ai-pr-written 태그가 없는 PR에 대해 처리를 수행합니다.
+    레포지토리의 PR 중 라벨이 없고 최근 6개월 이내에 생성된 PR을 반환합니다.
     """
-    github_token = os.getenv("GITHUB_TOKEN")
-    repo_name = os.getenv("GITHUB_REPOSITORY")
-    notion_token = os.getenv("NOTION_TOKEN")
-    system_prompt = os.getenv("SYSTEM_PROMPT") or ""
-    label_name = os.getenv("LABEL") or "ai-pr-written"
-
-    if not github_token or not repo_name or not notion_token:
-        raise EnvironmentError(
-            "GITHUB_TOKEN, GITHUB_REPOSITORY, NOTION_TOKEN 환경 변수가 필요합니다.")
-
-    auth = Auth.Token(github_token)
-    g = Github(auth=auth)
-    repo = g.get_repo(repo_name)
-
     open_prs = repo.get_pulls(state="all", sort="created", direction="desc")
     for pr in open_prs:
         # ai-pr-written 라벨이 이미 있으면 건너뜁니다.
@@ -450,57 +2598,298 @@ def process_all_prs():
             print(f"PR #{pr.number}은 최근 6개월 이내에 업데이트된 PR가 아니므로 건너뜁니다.")
             continue
 
-        # 해당 PR에 대해 clone을 수행합니다.
-        dest_dir = tempfile.mkdtemp(prefix="git_repo_")
-        print(
-            f"Cloning repository {repo_name} into temporary directory {dest_dir}...")
+        yield pr
 
-        repo = pr.base.repo
-        clone_url = repo.clone_url
-        pr_number = pr.number
-        # 1. 레포지토리 clone
-        print(f"Cloning repository {repo.full_name} into {dest_dir}...")
-        result = subprocess.run(
-            ["git", "clone", clone_url, dest_dir],
-            capture_output=True,
-            text=True
-        )
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to clone repository: {result.stderr}")
 
-        # 2. PR의 ref(fetch) – PR 번호에 해당하는 ref를 로컬 브랜치로 생성
-        fetch_command = ["git", "fetch", "origin",
-                         f"pull/{pr_number}/head:pr-{pr_number}"]
-        print(f"Fetching PR branch with command: {' '.join(fetch_command)}")
-        result = subprocess.run(
-            fetch_command,
-            cwd=dest_dir,
-            capture_output=True,
-            text=True
-        )
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to fetch PR branch: {result.stderr}")
+def ensure_mirror(repo, cache_dir: str = CACHE_DIR) -> str:
+    """
+    레포지토리의 bare 미러를 캐시 디렉토리에 준비합니다.
+    이미 있으면 재사용하므로 객체는 한 번만 전송됩니다.
 
-        # 3. 생성된 브랜치 체크아웃
-        checkout_command = ["git", "checkout", f"pr-{pr_number}"]
-        print(
-            f"Checking out branch with command: {' '.join(checkout_command)}")
-        result = subprocess.run(
-            checkout_command,
-            cwd=dest_dir,
-            capture_output=True,
-            text=True
+    Returns:
+        미러 저장소 경로
+    """
+    mirror_dir = os.path.join(
+        cache_dir, "repos", repo.full_name.replace("/", "__") + ".git")
+    with _MIRROR_LOCK:
+        if not os.path.isdir(mirror_dir):
+            print(f"Cloning repository {repo.full_name} into {mirror_dir}...")
+            os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+            _run_git(["clone", "--bare", repo.clone_url, mirror_dir])
+    return mirror_dir
+
+
+def fetch_pr_into_mirror(pr: PullRequest, mirror_dir: str) -> str:
+    """
+    미러에 PR의 head 와 base 커밋을 fetch 합니다.
+
+    Returns:
+        fetch 된 PR head 커밋 SHA
+    """
+    pr_number = pr.number
+    pr_ref = f"refs/pull/{pr_number}/head"
+    with _MIRROR_LOCK:
+        print(f"Fetching PR #{pr_number} into shared mirror...")
+        _run_git(
+            ["fetch", "origin", f"+pull/{pr_number}/head:{pr_ref}", pr.base.sha],
+            cwd=mirror_dir
         )
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to checkout branch: {result.stderr}")
+    return _run_git(["rev-parse", pr_ref], cwd=mirror_dir).strip()
+
 
-        print(f"Successfully cloned and checked out PR #{pr_number} branch.")
+def generate_pr_body_from_mirror(
+    pr: PullRequest,
+    clients: Clients,
+    system_prompt: str,
+    mirror_dir: str,
+    on_delta: Callable[[str], None] | None = None
+) -> str | None:
+    """
+    공유 미러에 PR 커밋을 fetch 한 뒤, 체크아웃 없이 base..head 를 비교하여 본문을 생성합니다.
+    """
+    print(f"\nProcessing PR #{pr.number}: {pr.title}")
+    head_sha = fetch_pr_into_mirror(pr, mirror_dir)
+    return generate_pr_body(
+        pr, clients, system_prompt, mirror_dir, head_sha=head_sha, on_delta=on_delta)
+
+
+def prepare_pr_body_request_from_mirror(
+    pr: PullRequest,
+    clients: Clients,
+    system_prompt: str,
+    mirror_dir: str
+) -> PrBodyRequest | None:
+    """
+    공유 미러에 PR 커밋을 fetch 한 뒤, LLM 호출 직전까지의 요청만 만듭니다.
+    """
+    print(f"\nPreparing PR #{pr.number}: {pr.title}")
+    head_sha = fetch_pr_into_mirror(pr, mirror_dir)
+    return prepare_pr_body_request(
+        pr, clients, system_prompt, mirror_dir, head_sha=head_sha)
+
+
+class _ThreadBufferedStdout:
+    """
+    buffered_call 을 실행 중인 스레드의 출력은 스레드별 버퍼에 모으고,
+    나머지 스레드(사용자에게 확인받는 메인 스레드)의 출력은 원래 stdout 으로 보내는 stdout 입니다.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        return (getattr(self.local, "buffer", None) or self.stream).write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def buffered_call(func: Callable, *args, **kwargs) -> tuple[str, object, Exception | None]:
+    """
+    func 를 실행하는 동안 이 스레드의 출력을 모아 두었다가 함께 반환합니다.
+    sys.stdout 이 _ThreadBufferedStdout 일 때만 출력을 모으고, 아니면 그대로 출력합니다.
+    여러 PR을 동시에 처리할 때 PR별 로그가 섞이거나 확인 프롬프트 사이에 끼어들지 않게 합니다.
+
+    Returns:
+        (모은 출력, func 의 반환값, func 가 발생시킨 예외 또는 None)
+    """
+    stdout = sys.stdout
+    buffer = io.StringIO()
+    if isinstance(stdout, _ThreadBufferedStdout):
+        stdout.local.buffer = buffer
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        return buffer.getvalue(), None, e
+    finally:
+        if isinstance(stdout, _ThreadBufferedStdout):
+            stdout.local.buffer = None
+    return buffer.getvalue(), result, None
+
+
+def inherit_output_buffer() -> Callable[[], None]:
+    """
+    현재 스레드의 출력 버퍼를 새 작업 스레드에서도 쓰도록 하는 ThreadPoolExecutor initializer 를 만듭니다.
+    buffered_call 안에서 만든 스레드의 출력도 같은 PR의 로그에 모으기 위함입니다.
+    """
+    stdout = sys.stdout
+    if not isinstance(stdout, _ThreadBufferedStdout):
+        return lambda: None
+    buffer = getattr(stdout.local, "buffer", None)
+
+    def initializer():
+        stdout.local.buffer = buffer
+
+    return initializer
+
+
+def process_all_prs_with_openai_batch(
+    repo,
+    clients: Clients,
+    system_prompt: str,
+    label_name: str,
+    mirror_dir: str,
+    workers: int
+):
+    """
+    대상 PR의 프롬프트를 모두 만든 뒤 OpenAI Batch API 작업 하나로 제출하고,
+    작업이 끝나면 결과를 PR마다 확인받아 적용합니다.
+    """
+    prepared: dict[str, tuple[PullRequest, PrBodyRequest]] = {}
+    stdout = sys.stdout
+    sys.stdout = _ThreadBufferedStdout(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    buffered_call, prepare_pr_body_request_from_mirror,
+                    pr, clients, system_prompt, mirror_dir): pr
+                for pr in iter_target_prs(repo, label_name)
+            }
+            for future in as_completed(futures):
+                pr = futures[future]
+                log, request, error = future.result()
+                print(log, end="")
+                if error:
+                    print(f"[ERROR] PR #{pr.number} 요청 준비에 실패했습니다: {error}")
+                    continue
+                if request is not None:
+                    prepared[f"pr-{pr.number}"] = (pr, request)
+    finally:
+        sys.stdout = stdout
+
+    if not prepared:
+        print("Batch 로 제출할 PR이 없습니다.")
+        return
+
+    results = run_openai_batch(
+        clients.openai,
+        {custom_id: request for custom_id, (_, request) in prepared.items()}
+    )
+    for custom_id, (pr, request) in sorted(
+            prepared.items(), key=lambda item: item[1][0].number):
+        if custom_id not in results:
+            print(f"[ERROR] PR #{pr.number} 의 Batch 결과가 없습니다.")
+            continue
+        ai_body = finalize_pr_body(request, results[custom_id])
+        if confirm_overwrite(pr.body, ai_body):
+            apply_pr_body(pr, ai_body, label_name)
+        else:
+            print(f"PR #{pr.number} 본문 업데이트가 취소되었습니다.")
+
+
+def process_all_prs(workers: int = 1, openai_batch: bool = False):
+    """
+    특정 레포지토리의 모든 열려있는 PR 중
+    ai-pr-written 태그가 없는 PR에 대해 처리를 수행합니다.
+
+    레포지토리는 캐시 디렉토리의 bare 미러 하나만 clone 하고,
+    PR마다 필요한 커밋만 fetch 한 뒤 체크아웃 없이 diff 하므로 객체는 한 번만 전송됩니다.
+    PR 본문 생성은 최대 workers 개의 스레드에서 동시에 수행하고,
+    생성이 끝난 순서대로 메인 스레드에서 그 PR의 로그를 출력한 뒤 사용자에게 덮어쓸지 확인합니다.
+    동시 실행 수가 workers 로 제한되므로 GitHub, 노션, OpenAI 호출 수도 그만큼으로 제한됩니다.
+    workers 가 1이면 새 본문을 스트리밍으로 받아 생성되는 대로 보여줍니다.
+    openai_batch 가 True 이면 모든 PR의 프롬프트를 OpenAI Batch API 작업 하나로 제출합니다.
+
+    Args:
+        workers (int): 동시에 본문을 생성(또는 요청을 준비)할 PR 수
+        openai_batch (bool): OpenAI Batch API 사용 여부
+    """
+    github_token = os.getenv("GITHUB_TOKEN")
+    repo_name = os.getenv("GITHUB_REPOSITORY")
+    notion_token = os.getenv("NOTION_TOKEN")
+    system_prompt = os.getenv("SYSTEM_PROMPT") or ""
+    label_name = LABEL_NAME
+
+    if not github_token or not repo_name or not notion_token:
+        raise EnvironmentError(
+            "GITHUB_TOKEN, GITHUB_REPOSITORY, NOTION_TOKEN 환경 변수가 필요합니다.")
+
+    # 모든 PR에서 같은 클라이언트(커넥션 풀)를 재사용합니다.
+    clients = create_clients(github_token, notion_token)
+    repo = clients.github.get_repo(repo_name)
+    mirror_dir = ensure_mirror(repo)
+
+    if openai_batch:
+        process_all_prs_with_openai_batch(
+            repo, clients, system_prompt, label_name, mirror_dir, workers)
+        return
+
+    if workers == 1:
+        for pr in iter_target_prs(repo, label_name):
+            try:
+                ai_body = generate_pr_body_from_mirror(
+                    pr, clients, system_prompt, mirror_dir,
+                    on_delta=make_streaming_preview(pr.body))
+            except Exception as e:
+                print(f"[ERROR] PR #{pr.number} 본문 생성에 실패했습니다: {e}")
+                continue
+
+            if ai_body is None:
+                print(f"PR #{pr.number} 본문을 갱신할 필요가 없습니다.")
+                continue
+            if ask_overwrite():
+                apply_pr_body(pr, ai_body, label_name)
+            else:
+                print(f"PR #{pr.number} 본문 업데이트가 취소되었습니다.")
+        return
+
+    # 작업 스레드의 로그는 PR별로 모아 두었다가 확인할 차례에 한꺼번에 출력합니다.
+    stdout = sys.stdout
+    sys.stdout = _ThreadBufferedStdout(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    buffered_call, generate_pr_body_from_mirror,
+                    pr, clients, system_prompt, mirror_dir): pr
+                for pr in iter_target_prs(repo, label_name)
+            }
+            # 생성이 끝난 PR부터 확인 대기열에서 꺼내 처리합니다.
+            for future in as_completed(futures):
+                pr = futures[future]
+                log, ai_body, error = future.result()
+                print(log, end="")
+                if error:
+                    print(f"[ERROR] PR #{pr.number} 본문 생성에 실패했습니다: {error}")
+                    continue
+
+                if ai_body is None:
+                    print(f"PR #{pr.number} 본문을 갱신할 필요가 없습니다.")
+                    continue
+                if confirm_overwrite(pr.body, ai_body):
+                    apply_pr_body(pr, ai_body, label_name)
+                else:
+                    print(f"PR #{pr.number} 본문 업데이트가 취소되었습니다.")
+    finally:
+        sys.stdout = stdout
 
-        process_single_pr(pr, notion_token, system_prompt,
-                          label_name, dest_dir, True)
 
-        # 작업 완료 후 임시 디렉토리 삭제
-        shutil.rmtree(dest_dir)
+def parse_batch_args(argv: list[str]) -> argparse.Namespace:
+    """
+    batch 모드의 명령행 인자를 파싱합니다.
+    """
+    parser = argparse.ArgumentParser(prog="ai_pr_write.py batch")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="동시에 본문을 생성할 PR 수 (기본 1)"
+    )
+    parser.add_argument(
+        "--openai-batch",
+        action="store_true",
+        help="모든 PR의 프롬프트를 OpenAI Batch API 작업 하나로 제출합니다."
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers 는 1 이상이어야 합니다.")
+    return args
 
 
 # ---------- 실행 진입점 ----------
@@ -508,6 +2897,14 @@ def process_all_prs():
 if __name__ == "__main__":
     # 명령행 인자로 "batch"가 주어지면 전체 PR 처리, 없으면 단일 PR 처리
     if len(sys.argv) > 1 and sys.argv[1] == "batch":
-        process_all_prs()
+        batch_args = parse_batch_args(sys.argv[2:])
+        process_all_prs(
+            workers=batch_args.workers, openai_batch=batch_args.openai_batch)
+    elif len(sys.argv) > 1 and sys.argv[1] == "invalidate-cache":
+        token = os.getenv("NOTION_TOKEN")
+        if not token:
+            raise EnvironmentError("NOTION_TOKEN 환경 변수가 필요합니다.")
+        invalidate_cached_prefixes(token)
+        print("노션 데이터베이스 접두사 캐시를 삭제했습니다.")
     else:
         process_single_pr_from_env()
@@ -7,5 +7,27 @@ export PR_NUMBER="$INPUT_PR_NUMBER"
 export NOTION_TOKEN="$INPUT_NOTION_TOKEN"
 export SYSTEM_PROMPT="$INPUT_SYSTEM_PROMPT"
 export LABEL="$INPUT_LABEL"
+export AI_PR_WRITER_CACHE_DIR="$INPUT_CACHE_DIR"
+export NOTION_PREFIX_CACHE_TTL="$INPUT_NOTION_PREFIX_CACHE_TTL"
+export NOTION_PREFIX_REFRESH_INTERVAL="$INPUT_NOTION_PREFIX_REFRESH_INTERVAL"
+export GIT_FETCH_MODE="$INPUT_FETCH_MODE"
+export MAX_PROMPT_TOKENS="$INPUT_MAX_PROMPT_TOKENS"
+export SUMMARY_MODEL="$INPUT_SUMMARY_MODEL"
+export LLM_CACHE="$INPUT_LLM_CACHE"
+export INCREMENTAL="$INPUT_INCREMENTAL"
+export LLM_STREAM="$INPUT_LLM_STREAM"
+export LLM_TIMEOUT="$INPUT_LLM_TIMEOUT"
+export LLM_MODEL="$INPUT_LLM_MODEL"
+export LLM_BASE_URL="$INPUT_LLM_BASE_URL"
+export LLM_REASONING_EFFORT="$INPUT_LLM_REASONING_EFFORT"
+export LLM_MAX_TOKENS="$INPUT_LLM_MAX_TOKENS"
+export LLM_ROUTING="$INPUT_LLM_ROUTING"
+export SMALL_LLM_MODEL="$INPUT_SMALL_LLM_MODEL"
+export API_MAX_RETRIES="$INPUT_API_MAX_RETRIES"
+export NOTION_MAX_DEPTH="$INPUT_NOTION_MAX_DEPTH"
+export NOTION_MAX_BLOCKS="$INPUT_NOTION_MAX_BLOCKS"
+export NOTION_MAX_TOKENS="$INPUT_NOTION_MAX_TOKENS"
+export NOTION_SKIP_BLOCK_TYPES="$INPUT_NOTION_SKIP_BLOCK_TYPES"
+export NOTION_TASK_MAPPING="$INPUT_NOTION_TASK_MAPPING"
 
 python /app/ai_pr_write.py